@@ -7,7 +7,7 @@ import glob
 import pandas as pd
 import subprocess
 from subprocess import DEVNULL
-from fluorite import ProjectHistory, GazeDataPartition
+from fluorite import ProjectHistory, GazeDataPartition, EditCoalescer
 from itrace_post import post_to_aoi, create_combined_archive
 
 """
@@ -16,6 +16,18 @@ Parameters for gaze2src:
 FILTER = "ivt"
 FILTER_ARGS = ["-v 30", "-u 60"]
 
+"""
+Parsed FLUORITE logs are cached here, so that reruns skip XML parsing.
+"""
+FLUORITE_CACHE_DIR = "processed_data/fluorite_cache"
+
+"""
+Edits are merged into one timeline period until typing pauses for this long (in milliseconds).
+A period covers its burst of edits and shows the code as it is after the burst. Edits that add
+or remove lines get their own period, so gazes during a burst still map to the right lines.
+"""
+COALESCE_EDITS = EditCoalescer(quiet_gap=1000, same_file=True, split_on_line_change=True)
+
 
 def make_and_process_data_partition(function_index, entity_index, fluorite_log,
                         eclipse_log, core_log, output_dir, compute_aois=False):
@@ -24,19 +36,21 @@ def make_and_process_data_partition(function_index, entity_index, fluorite_log,
 
     # Create a ProjectHistory object from a Fluorite log file
     phist = ProjectHistory(fluorite_log, func_location_file=function_index,
-                           entity_location_file=entity_index)
+                           entity_location_file=entity_index,
+                           cache_dir=FLUORITE_CACHE_DIR)
+    print("FLUORITE log cache " + phist.cache_status + ": " + fluorite_log)
 
-    # In our timezone at least, the time iTrace records is 4 or 5 hours behind that of FLUORITE.
-    # TODO since this varies, maybe check it automatically and round to the nearest hour difference.
-    time_offset = 5*3600*1000
+    # iTrace time stamps are converted to UTC using their time zone suffix, so they line up with FLUORITE.
+    time_offset = 0
 
     # Create a DataPartition to split the plugin log file
     data_part = GazeDataPartition(eclipse_log, time_offset)
 
-    # Save a corresponding file timeline
+    # Save a corresponding file timeline. Files that do not change between frames are stored once.
     time_periods = phist.save_timeline(output_dir, granularity='finest',
                                        first_time=data_part.first_time,
-                                       last_time=data_part.last_time)
+                                       last_time=data_part.last_time,
+                                       link="hard", coalesce=COALESCE_EDITS)
 
     # Separate the data
     data_part.create_partition(time_periods=time_periods)
@@ -59,8 +73,9 @@ def make_and_process_data_partition(function_index, entity_index, fluorite_log,
         if not os.path.exists(prefix+"/plugin_log.xml"):
             continue
 
-        # Create a tarball of code files
-        subprocess.run(["tar", "-czf", prefix+"/src.tar.gz", prefix+"/code_files"],
+        # Create a tarball of code files. Identical files are hard links to one object, which must be
+        # stored in full each time (not as link entries), since srcml reads the tarball entry by entry.
+        subprocess.run(["tar", "--hard-dereference", "-czf", prefix+"/src.tar.gz", prefix+"/code_files"],
                        stdout=DEVNULL, stderr=DEVNULL)
 
         # Run srcml
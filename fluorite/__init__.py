@@ -1,4 +1,7 @@
 from .reader import FileHistory, ProjectHistory
-from .partition import GazeDataPartition, date_to_epoch
+from .sessions import MultiSessionHistory
+from .timeline_archive import TimelineArchive, TimelineArchiveWriter
+from .coalesce import EditCoalescer
+from .partition import GazeDataPartition, date_to_epoch, timestamps_to_epoch, load_partition_columns
 from .make_log_report import make_fluorite_log_report
 from .make_log_report import fields as alpscarf_fields
@@ -0,0 +1,61 @@
+"""
+An on-disk cache of parsed FLUORITE logs, so that a log only has to be parsed once.
+"""
+
+import os
+import pickle
+import hashlib
+
+# Increment whenever the layout of cached data (or of the change event classes) changes
+CACHE_VERSION = 3
+
+"""
+Returns a key that identifies the content of a log file: the SHA-1 digest of the file and its size.
+"""
+
+
+def log_file_key(logfile):
+    digest = hashlib.sha1()
+    with open(logfile, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest() + "-" + str(os.path.getsize(logfile))
+
+
+def _cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + "-v" + str(CACHE_VERSION) + ".pickle")
+
+
+"""
+Returns the data cached under key, or None if there is no usable entry.
+"""
+
+
+def load_cached_log(cache_dir, key):
+    path = _cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as infile:
+            return pickle.load(infile)
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+"""
+Caches data under key. The entry is written under a temporary name first,
+so that an interrupted run never leaves a partial entry behind.
+"""
+
+
+def save_cached_log(cache_dir, key, data):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    path = _cache_path(cache_dir, key)
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, "wb") as ofile:
+        pickle.dump(data, ofile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
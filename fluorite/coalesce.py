@@ -0,0 +1,102 @@
+"""
+Merges bursts of edits, so that a timeline has one period per burst instead of one per edit.
+"""
+
+from .reader import InsertionEvent, DeletionEvent, ReplaceEvent
+
+"""
+A run of consecutive changes that is treated as a single edit.
+
+Fields:
+    changes: The changes in the burst, sorted by start time.
+    time_1: The time at which the first change began.
+    end_time: The latest time at which any change in the burst completed.
+    changed_file: The file that was changed, or None if the burst changes several files.
+"""
+
+
+class EditBurst:
+    __slots__ = ["changes", "time_1", "end_time", "changed_file"]
+
+    def __init__(self, change):
+        self.changes = [change]
+        self.time_1 = change.time_1
+        self.end_time = change.end_time
+        self.changed_file = change.changed_file
+
+    def add(self, change):
+        self.changes.append(change)
+        self.end_time = max(self.end_time, change.end_time)
+        if change.changed_file != self.changed_file:
+            self.changed_file = None
+
+
+"""
+The rules for merging changes into bursts. Changes are taken in order of start time, and a change
+joins the burst before it unless one of the rules separates them.
+
+Parameters:
+    quiet_gap: A burst ends once no change starts for quiet_gap milliseconds after it completes.
+    same_file: If True, a burst only holds changes to one file.
+    split_on_line_change: If True, a change that inserts or removes a line break forms a burst
+        of its own, so that lines never move within a burst.
+"""
+
+
+class EditCoalescer:
+    def __init__(self, quiet_gap, same_file=True, split_on_line_change=False):
+        if quiet_gap < 0:
+            raise ValueError(
+                "quiet_gap must not be negative, not "+str(quiet_gap)
+            )
+
+        self.quiet_gap = quiet_gap
+        self.same_file = same_file
+        self.split_on_line_change = split_on_line_change
+
+    """
+    Returns the bursts formed by a list of changes (such as ProjectHistory.get_all_changes()),
+    sorted by start time. A burst has the time_1 and end_time fields of a change, so a list of
+    bursts can be used wherever the timeline uses the list of changes.
+    """
+    def coalesce(self, changes):
+        bursts = list()
+        current = None
+        current_moves_lines = False
+
+        for change in sorted(changes, key=lambda c: c.time_1):
+            moves_lines = self.split_on_line_change and changes_lines(change)
+
+            if current is not None and not current_moves_lines and not moves_lines and \
+                    change.time_1 - current.end_time < self.quiet_gap and \
+                    (not self.same_file or change.changed_file == current.changed_file):
+                current.add(change)
+                continue
+
+            current = EditBurst(change)
+            current_moves_lines = moves_lines
+            bursts.append(current)
+
+        return bursts
+
+
+"""
+Returns True if a change inserts or removes a line break.
+A replacement whose replaced string is not known is assumed to do so.
+"""
+
+
+def changes_lines(change):
+    if type(change) is InsertionEvent:
+        return "\n" in change.string_inserted
+
+    if type(change) is DeletionEvent:
+        return "\n" in change.string_deleted
+
+    if type(change) is ReplaceEvent:
+        return change.string_replaced is None or \
+            "\n" in change.string_replaced or "\n" in change.replace_with
+
+    raise ValueError(
+        "Cannot inspect non-event type "+str(type(change))
+    )
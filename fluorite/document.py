@@ -0,0 +1,205 @@
+"""
+A text document model that applies edits without copying the whole text.
+"""
+
+from .fenwick import FenwickTree
+
+# The target number of characters held by each chunk of a Document
+CHUNK_SIZE = 2048
+
+"""
+A document stored as a list of bounded-size chunks (a flat rope).
+
+An edit rewrites only the chunks it touches. Fenwick trees over the length and the
+newline count of each chunk locate the chunk holding any offset or line in O(log n) time,
+so conversions between offsets and (line, column) pairs only scan a single chunk.
+Copies share their chunks, so a Document can be checkpointed cheaply.
+The full text is only built by str().
+
+Offsets behave like string slice indices: they are clamped to the length of the document.
+Lines and columns are zero-based, and lines are terminated by "\n" (a "\r\n" separator
+leaves the "\r" at the end of its line).
+
+Parameters:
+    text: The initial content of the document.
+    chunk_size: The target number of characters in each chunk.
+"""
+
+
+class Document:
+    def __init__(self, text="", chunk_size=CHUNK_SIZE):
+        self.chunk_size = int(chunk_size)
+        self._chunks = self._split(text)
+        self._lengths = FenwickTree(len(chunk) for chunk in self._chunks)
+        self._newlines = FenwickTree(chunk.count("\n") for chunk in self._chunks)
+        self._length = len(text)
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return "".join(self._chunks)
+
+    def copy(self):
+        other = Document.__new__(Document)
+        other.chunk_size = self.chunk_size
+        other._chunks = list(self._chunks)
+        other._lengths = self._lengths.copy()
+        other._newlines = self._newlines.copy()
+        other._length = self._length
+        return other
+
+    """
+    Inserts text before the character at the given offset.
+    """
+    def insert(self, offset, text):
+        if not text:
+            return
+
+        offset = self._clamp(offset)
+        index, inner = self._locate(offset)
+        chunk = self._chunks[index]
+        chunk = chunk[:inner] + text + chunk[inner:]
+
+        self._length += len(text)
+        if len(chunk) > 2 * self.chunk_size:
+            self._chunks[index:index + 1] = self._split(chunk)
+            self._rebuild()
+        else:
+            self._chunks[index] = chunk
+            self._lengths.add(index, len(text))
+            self._newlines.add(index, text.count("\n"))
+
+    """
+    Removes the characters in the range [start, end).
+    """
+    def delete(self, start, end):
+        start, end = self._clamp(start), self._clamp(end)
+        if end <= start:
+            return
+
+        first, first_inner = self._locate(start)
+        last, last_inner = self._locate(end)
+        self._length -= end - start
+
+        if first == last:
+            chunk = self._chunks[first]
+            self._chunks[first] = chunk[:first_inner] + chunk[last_inner:]
+            self._lengths.add(first, start - end)
+            self._newlines.add(first, -chunk.count("\n", first_inner, last_inner))
+            if not self._chunks[first] and len(self._chunks) > 1:
+                del self._chunks[first]
+                self._rebuild()
+            return
+
+        self._chunks[last] = self._chunks[last][last_inner:]
+        self._chunks[first] = self._chunks[first][:first_inner]
+        del self._chunks[first + 1:last]
+        self._chunks = [chunk for chunk in self._chunks if chunk] or [""]
+        self._rebuild()
+
+    """
+    Replaces the characters in the range [start, end) with text.
+    """
+    def replace(self, start, end, text):
+        self.delete(start, end)
+        self.insert(start, text)
+
+    """
+    Returns the characters in the range [start, end) as a string.
+    """
+    def slice(self, start, end):
+        start, end = self._clamp(start), self._clamp(end)
+        if end <= start:
+            return ""
+
+        first, first_inner = self._locate(start)
+        last, last_inner = self._locate(end)
+
+        if first == last:
+            return self._chunks[first][first_inner:last_inner]
+
+        pieces = [self._chunks[first][first_inner:]]
+        pieces.extend(self._chunks[first + 1:last])
+        pieces.append(self._chunks[last][:last_inner])
+        return "".join(pieces)
+
+    """
+    Returns the number of newline characters in the range [start, end).
+    """
+    def count_newlines(self, start, end):
+        start, end = self._clamp(start), self._clamp(end)
+        if end <= start:
+            return 0
+        return self.line_of(end) - self.line_of(start)
+
+    """
+    Returns the number of lines in the document (one more than the number of newlines).
+    """
+    def line_count(self):
+        return self._newlines.prefix_sum(len(self._chunks)) + 1
+
+    """
+    Returns the line that contains the character at offset (the number of newlines before it).
+    """
+    def line_of(self, offset):
+        index, inner = self._locate(self._clamp(offset))
+        return self._newlines.prefix_sum(index) + self._chunks[index].count("\n", 0, inner)
+
+    """
+    Returns the offset of the first character of a line.
+    """
+    def line_start(self, line):
+        if line < 0 or line >= self.line_count():
+            raise ValueError(
+                "Line "+str(line)+" is outside of a document with "+str(self.line_count())+" lines"
+            )
+
+        if line == 0:
+            return 0
+
+        # The chunk holding the newline that ends the previous line
+        index = self._newlines.search(line - 1)
+        remaining = line - self._newlines.prefix_sum(index)
+        chunk = self._chunks[index]
+
+        position = -1
+        for _ in range(remaining):
+            position = chunk.find("\n", position + 1)
+
+        return self._lengths.prefix_sum(index) + position + 1
+
+    """
+    Converts an offset to a (line, column) pair.
+    """
+    def offset_to_line_col(self, offset):
+        offset = self._clamp(offset)
+        line = self.line_of(offset)
+        return line, offset - self.line_start(line)
+
+    """
+    Converts a (line, column) pair to an offset. Columns past the end of the line are not checked.
+    """
+    def line_col_to_offset(self, line, col):
+        return self._clamp(self.line_start(line) + col)
+
+    def _clamp(self, offset):
+        return min(max(int(offset), 0), self._length)
+
+    """
+    Returns the chunk index and the offset within that chunk of a (clamped) document offset.
+    """
+    def _locate(self, offset):
+        index = self._lengths.search(offset)
+        if index >= len(self._chunks):
+            index = len(self._chunks) - 1
+        return index, offset - self._lengths.prefix_sum(index)
+
+    def _split(self, text):
+        if not text:
+            return [""]
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def _rebuild(self):
+        self._lengths = FenwickTree(len(chunk) for chunk in self._chunks)
+        self._newlines = FenwickTree(chunk.count("\n") for chunk in self._chunks)
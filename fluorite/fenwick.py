@@ -0,0 +1,99 @@
+"""
+A Fenwick (binary indexed) tree, used to maintain running totals over sequences that change in place.
+"""
+
+"""
+A Fenwick tree over a sequence of integers.
+Supports point updates and prefix sums in O(log n) time.
+
+Parameters:
+    values: The initial sequence. The tree has a fixed length equal to the length of this sequence.
+"""
+
+
+class FenwickTree:
+    def __init__(self, values=()):
+        self._tree = [0] + [int(value) for value in values]
+
+        # Build in linear time by pushing each partial sum to its parent
+        size = len(self._tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def copy(self):
+        other = FenwickTree()
+        other._tree = list(self._tree)
+        return other
+
+    """
+    Adds delta to the value at the given (zero-based) index.
+    """
+    def add(self, index, delta):
+        i = index + 1
+        size = len(self._tree)
+        while i < size:
+            self._tree[i] += delta
+            i += i & -i
+
+    """
+    Returns the sum of the first 'count' values.
+    """
+    def prefix_sum(self, count):
+        total = 0
+        i = count
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    """
+    Returns the value at the given (zero-based) index.
+    """
+    def get(self, index):
+        return self.prefix_sum(index + 1) - self.prefix_sum(index)
+
+    """
+    Returns the values at the (zero-based) indices [start, end) as a list. Each value is recovered from
+    its node by subtracting the node's children, which takes O(end - start + log n) time in total.
+    """
+    def values(self, start=0, end=None):
+        if end is None:
+            end = len(self)
+
+        result = list()
+        for i in range(start + 1, end + 1):
+            value = self._tree[i]
+            child = i - 1
+            stop = i - (i & -i)
+            while child > stop:
+                value -= self._tree[child]
+                child -= child & -child
+            result.append(value)
+
+        return result
+
+    """
+    Returns the number of leading values whose sum does not exceed target.
+    When all values are non-negative, this is the index of the value that contains
+    the position 'target' in the concatenation of the sequence.
+    """
+    def search(self, target):
+        position = 0
+        remaining = target
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+
+        while step > 0:
+            following = position + step
+            if following < len(self._tree) and self._tree[following] <= remaining:
+                position = following
+                remaining -= self._tree[following]
+            step //= 2
+
+        return position
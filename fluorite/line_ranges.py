@@ -0,0 +1,169 @@
+"""
+An index of function or entity line ranges that can be shifted by edits without visiting every range.
+"""
+
+import itertools
+from .fenwick import FenwickTree
+
+"""
+The line ranges of a function index or an entity index, for a single file.
+
+Every range boundary is stored once, in sorted order, together with a Fenwick tree of
+pending shifts. Inserting or removing lines is a range update on the boundaries that
+follow the edit, so it costs O(log^2 n) instead of a pass over every range.
+
+Boundaries are compared on a doubled scale (2 * start - 1 for starts, 2 * end for ends),
+so that "start > line" and "end >= line" become the same test: "key >= 2 * line".
+
+Parameters:
+    ranges: A function index ({name: [start, end]}) or, if nested is True,
+        an entity index ({entity type: {name: [start, end]}}).
+    nested: True for entity indices.
+"""
+
+
+class LineRangeIndex:
+    def __init__(self, ranges, nested=False):
+        self.nested = nested
+
+        # Keys of the outer dictionary, so that empty entity types survive a round trip
+        self._groups = list(ranges.keys()) if nested else None
+
+        # For each range: its key path and any fields that follow [start, end]
+        self._names = list()
+        self._extras = list()
+
+        boundaries = list()
+        if nested:
+            items = ((group, name, line_range)
+                     for group, members in ranges.items()
+                     for name, line_range in members.items())
+        else:
+            items = ((None, name, line_range) for name, line_range in ranges.items())
+
+        for group, name, line_range in items:
+            range_id = len(self._names)
+            self._names.append((group, name))
+            self._extras.append(list(line_range[2:]))
+            boundaries.append((2 * line_range[0] - 1, 2 * range_id))
+            boundaries.append((2 * line_range[1], 2 * range_id + 1))
+
+        boundaries.sort()
+
+        # Base key of each rank, and the boundary (2 * range id, plus 1 for ends) stored at each rank
+        self._keys = [key for key, _ in boundaries]
+        self._owners = [owner for _, owner in boundaries]
+
+        # The key at rank i is self._keys[i] + self._offsets.prefix_sum(i + 1)
+        self._offsets = FenwickTree([0] * len(boundaries))
+
+        self.version = 0
+        self._cache = None
+        self._cache_version = None
+
+    def copy(self):
+        other = LineRangeIndex.__new__(LineRangeIndex)
+        other.nested = self.nested
+        other._groups = self._groups
+        other._names = self._names
+        other._extras = self._extras
+        other._keys = self._keys
+        other._owners = list(self._owners)
+        other._offsets = self._offsets.copy()
+        other.version = self.version
+        other._cache = self._cache
+        other._cache_version = self._cache_version
+        return other
+
+    """
+    Moves every range boundary after first_line by net_added lines.
+    A start moves if it is greater than first_line, and an end moves if it is at least first_line.
+    """
+    def shift(self, first_line, net_added):
+        if net_added == 0 or len(self._keys) == 0:
+            return
+
+        threshold = 2 * first_line
+        delta = 2 * net_added
+        rank = self._first_rank_at_least(threshold)
+        if rank == len(self._keys):
+            return
+
+        if net_added < 0:
+            low = self._first_rank_at_least(threshold + delta)
+
+        self._offsets.add(rank, delta)
+        self.version += 1
+
+        if net_added < 0:
+            # Removed lines can carry boundaries back past ones that did not move; restore the order
+            high = self._first_rank_at_least(threshold, rank)
+            if low < rank < high:
+                self._sort_ranks(low, high)
+
+    """
+    Returns the index as a dictionary in the format it was given in.
+    The dictionary is shared by every copy of this index until the next shift, so it must not be modified.
+    """
+    def to_dict(self):
+        if self._cache_version == self.version and self._cache is not None:
+            return self._cache
+
+        bounds = [[None, None] for _ in self._names]
+        for owner, key in zip(self._owners, self._current_keys(0, len(self._keys))):
+            if owner % 2 == 0:
+                bounds[owner // 2][0] = (key + 1) // 2
+            else:
+                bounds[owner // 2][1] = key // 2
+
+        if self.nested:
+            result = dict((group, dict()) for group in self._groups)
+            for (group, name), line_range, extra in zip(self._names, bounds, self._extras):
+                result[group][name] = line_range + extra
+        else:
+            result = dict()
+            for (_, name), line_range, extra in zip(self._names, bounds, self._extras):
+                result[name] = line_range + extra
+
+        self._cache, self._cache_version = result, self.version
+        return result
+
+    def _key(self, rank):
+        return self._keys[rank] + self._offsets.prefix_sum(rank + 1)
+
+    """
+    Returns the keys of ranks [low, high), keeping a running sum of the offsets
+    instead of computing a prefix sum for each rank.
+    """
+    def _current_keys(self, low, high):
+        values = self._offsets.values(low, high)
+        if len(values) > 0:
+            values[0] += self._offsets.prefix_sum(low)
+
+        return [base + offset for base, offset in zip(self._keys[low:high], itertools.accumulate(values))]
+
+    def _first_rank_at_least(self, key, low=0):
+        high = len(self._keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    """
+    Re-sorts the boundaries held by ranks [low, high) by their current keys.
+    """
+    def _sort_ranks(self, low, high):
+        current = self._current_keys(low, high)
+        window = sorted(zip(current, self._owners[low:high]))
+
+        # Moving the key of one rank leaves the keys of the ranks after it unchanged
+        for rank, (key, owner), current_key in zip(range(low, high), window, current):
+            difference = key - current_key
+            if difference != 0:
+                self._offsets.add(rank, difference)
+                if rank + 1 < len(self._keys):
+                    self._offsets.add(rank + 1, -difference)
+            self._owners[rank] = owner
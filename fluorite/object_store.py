@@ -0,0 +1,87 @@
+"""
+A content-addressed store for the files written into a timeline, so that identical files are stored once.
+"""
+
+import os
+import shutil
+import hashlib
+
+"""
+A directory of text objects named by the SHA-1 digest of their content.
+Files in the timeline are created as links to these objects.
+
+Parameters:
+    root: The directory that holds the objects.
+    link: How timeline files refer to objects: "hard" for hard links, "symbolic" for relative
+        symbolic links. Hard links fall back to copies on file systems that do not support them.
+"""
+
+
+class ObjectStore:
+    def __init__(self, root, link="hard"):
+        if link not in ["hard", "symbolic"]:
+            raise ValueError(
+                "Parameter 'link' must be one of 'hard' or 'symbolic', not "+str(link)
+            )
+
+        self.root = root
+        self.link_type = link
+
+        # Digests of text that has already been stored, by caller-supplied key
+        self._known_digests = dict()
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    """
+    Stores text (if no identical object exists yet) and returns its digest.
+    If key is given, later calls with the same key return the same digest without
+    looking at text, which can then be a callable that produces the text on demand.
+    """
+    def put(self, text, key=None):
+        if key is not None and key in self._known_digests:
+            return self._known_digests[key]
+
+        if callable(text):
+            text = text()
+
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        path = self.path(digest)
+
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write under a temporary name so that a partly written object is never visible
+            temp_path = path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, "w") as ofile:
+                ofile.write(text)
+            os.replace(temp_path, path)
+
+        if key is not None:
+            self._known_digests[key] = digest
+
+        return digest
+
+    """
+    Makes target_path refer to the object with the given digest, replacing any existing file.
+    """
+    def link(self, digest, target_path):
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+
+        source = self.path(digest)
+        if self.link_type == "symbolic":
+            os.symlink(os.path.relpath(source, os.path.dirname(os.path.abspath(target_path))), target_path)
+            return
+
+        try:
+            os.link(source, target_path)
+        except OSError:
+            shutil.copyfile(source, target_path)
+
+    """
+    Returns the path of the object with the given digest.
+    """
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
@@ -8,9 +8,11 @@ the session.
 import datetime
 import pandas as pd
 import numpy as np
-import glob
 import os
-import xml.etree.ElementTree
+import mmap
+import tempfile
+import zipfile
+import xml.parsers.expat
 
 # A time object representing zero in unix time (0 milliseconds after 00 UTC on January 1, 1970)
 try:
@@ -18,8 +20,20 @@ try:
 except OSError:
     EPOCH = datetime.datetime.utcfromtimestamp(0)
 
+# The number of bytes of a data file that are parsed at a time
+READ_BLOCK_SIZE = 1 << 16
+
+# The columns of the columnar (npz and parquet) output of GazeDataPartition.save_partition.
+# Rows without a partition have Partition -1, and missing pupil diameters are NaN.
+COLUMNS = ["sys_time", "row_num", "Partition", "x", "y", "event_time", "left_pupil", "right_pupil"]
+
+# The smallest number of rows in a row group of the Parquet output, except for the last
+PARQUET_ROW_GROUP_SIZE = 1 << 16
+
 """
-A conversion from datetime to epoch/unix time
+A conversion from datetime to epoch/unix time.
+The time zone suffix is ignored, so the result is only in UTC if the local time zone of
+the recording matches that of this machine. New code should use timestamps_to_epoch.
 """
 
 
@@ -28,68 +42,280 @@ def date_to_epoch(date_str):
             .total_seconds() * 1000
 
 
+"""
+Converts a sequence of ISO 8601 time stamps with time zone suffixes (as written by iTrace,
+e.g. "2019-07-11T11:32:20.262-05:00") to UTC epoch/unix time, in whole milliseconds.
+All time stamps are parsed at once, and the result is an int64 numpy array.
+Unlike date_to_epoch, the result does not depend on the local time zone, and it differs from
+date_to_epoch by the UTC offset of the recording's time zone (e.g. 5 hours for "-05:00").
+"""
+
+
+def timestamps_to_epoch(timestamps):
+    times = pd.to_datetime(pd.Series(timestamps, dtype=object), utc=True)
+    return ((times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(milliseconds=1)).to_numpy(dtype=np.int64)
+
+
+"""
+Appends the bytes [start, end) of a source file to a target file descriptor.
+The copy is made by the kernel (with copy_file_range or sendfile) where possible,
+and from source_map, a memory map of the source, otherwise.
+"""
+
+
+def copy_byte_range(source_fd, source_map, target_fd, start, end):
+    start, end = int(start), int(end)
+
+    try:
+        while start < end:
+            copied = os.copy_file_range(source_fd, target_fd, end - start, start)
+            if copied == 0:
+                break
+            start += copied
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        while start < end:
+            copied = os.sendfile(target_fd, source_fd, start, end - start)
+            if copied == 0:
+                break
+            start += copied
+    except (AttributeError, OSError):
+        pass
+
+    view = memoryview(source_map)
+    try:
+        while start < end:
+            start += os.write(target_fd, view[start:end])
+    finally:
+        view.release()
+
+"""
+Locates times in a list of [start, end) time periods, as given to create_partition(time_periods=...).
+A time that is in several periods belongs to the last of them. Only the periods that contain data
+are given partition numbers, in order.
+"""
+
+
+class _PeriodLocator:
+    def __init__(self, time_periods):
+        # Periods that end before they start are empty
+        periods = np.array([[time_1, time_2] for time_1, time_2 in time_periods if time_2 > time_1],
+                           dtype=np.float64).reshape(-1, 2)
+
+        self.disjoint = bool(np.all(periods[1:, 0] >= periods[:-1, 1]))
+        if not self.disjoint:
+            periods = np.array([[time_1, time_2] for time_1, time_2 in time_periods],
+                               dtype=np.float64).reshape(-1, 2)
+
+        self.periods = periods
+        self.count = len(periods)
+
+    """
+    Returns the period of each time (-1 if it is in none), and whether each period contains any of the times.
+    """
+    def locate(self, sys_time):
+        starts, ends = self.periods[:, 0], self.periods[:, 1]
+
+        if self.disjoint:
+            # Sorted, disjoint periods: find the period of each time with a single binary search
+            period = np.searchsorted(starts, sys_time, side="right") - 1
+            inside = period >= 0
+            inside[inside] = sys_time[inside] < ends[period[inside]]
+            period[~inside] = -1
+            return period, np.bincount(period[inside], minlength=self.count) > 0
+
+        # Unsorted or overlapping periods: later periods take times from earlier ones
+        period = np.full(len(sys_time), -1, dtype=np.int64)
+        occupied = np.zeros(self.count, dtype=bool)
+        for index in range(self.count):
+            region = (sys_time >= starts[index]) & (sys_time < ends[index])
+            occupied[index] = region.any()
+            period[region] = index
+
+        return period, occupied
+
+    """
+    Returns the partition number of each period, given which periods contain data.
+    """
+    def numbers(self, occupied):
+        return np.cumsum(occupied) - 1
+
+
+"""
+Locates times between evenly spaced time steps, as given to create_partition(period=...) or
+create_partition(num_parts=...). A time belongs to the last step at or before it. Times after
+the last step only belong to a partition if after_last is True. Partitions are numbered by step.
+"""
+
+
+class _StepLocator:
+    def __init__(self, times, after_last):
+        self.times = np.array(times, dtype=np.float64)
+        self.count = len(self.times) if after_last else max(len(self.times) - 1, 0)
+
+    def locate(self, sys_time):
+        period = np.searchsorted(self.times, sys_time, side="right") - 1
+        period[period >= self.count] = -1
+        return period, np.bincount(period[period >= 0], minlength=self.count) > 0
+
+    def numbers(self, occupied):
+        return np.arange(self.count)
+
+
 """
 A partitioner for gaze data.
 
 Construction parameters:
     data_filename: The relative path to a complete XML data file
     offset_ms: The amount of time by which to increase any timestamps, in milliseconds.
+        Time stamps are converted to UTC using their time zone, so they are already
+        aligned with FLUORITE logs without an offset. Older versions read them as local time
+        and needed the time zone as an offset (such as 4*3600*1000); pass 0 instead now, or
+        every time will be shifted by the time zone twice.
+    chunk_size: If given, the data file is never held in memory. Instead, it is streamed in batches of
+        chunk_size gaze responses whenever the data is needed, and only a few numbers per partition are kept.
+        data is None in this mode.
 """
 
 
 class GazeDataPartition:
-    def __init__(self, data_filename, offset_ms):
+    def __init__(self, data_filename, offset_ms, chunk_size=None):
+        if chunk_size is not None and int(chunk_size) < 1:
+            raise ValueError(
+                "chunk_size must be a positive integer, not "+str(chunk_size)
+            )
+
         self.files = dict()
         self.data_filename = data_filename
+        self.offset_ms = offset_ms
+        self.chunk_size = None if chunk_size is None else int(chunk_size)
         self.data = None
         self.partition_count = None
         self.first_time = None
         self.last_time = None
-        self.read_xml_data(data_filename, offset_ms)
+        self.row_count = None
+
+        # Byte offsets in the data file: the start of each gaze response (by row number),
+        # the start of the first response, and the start of the tag that closes the list of responses
+        self.response_offsets = None
+        self.gazes_start_offset = None
+        self.gazes_end_offset = None
+
+        # In chunked mode: the byte offsets of the first and last row of each partition,
+        # and what is needed to find the partition of a row again
+        self.partition_offsets = None
+        self._locator = None
+        self._numbers = None
+
+        if self.chunk_size is None:
+            self.read_xml_data(data_filename, offset_ms)
+        else:
+            self.scan_xml_data(data_filename, offset_ms)
 
     """
-    Ingests XML data
+    Ingests XML data. The file is streamed, and the byte offset of each gaze response is
+    recorded so that save_partition can copy responses without parsing the file again.
     """
     def read_xml_data(self, plugin_filename, offset_ms):
-        # Read plugin file
-        tree = xml.etree.ElementTree.parse(plugin_filename)
-        root = tree.getroot()
-        gazes = root[1]
-
-        df_dict = {"fix_time": [], "row_num": []}
-
-        index = 0
-        for response in gazes:
-            df_dict["fix_time"].append(response.attrib['timestamp'])
-            df_dict["row_num"].append(index)
-            index += 1
-
-        self.data = pd.DataFrame.from_dict(df_dict)
-
-        # Create epoch time column
-        self.data["sys_time"] = list(map(
-            lambda dt_str: date_to_epoch(dt_str) + offset_ms,
-            self.data["fix_time"]
-        ))
+        batches = list(self._read_batches(plugin_filename, offset_ms, None))
+        self.data, self.response_offsets = batches[0]
+        self.row_count = len(self.data)
 
         self.first_time = self.data["sys_time"].iloc[0]
         self.last_time = self.data["sys_time"].iloc[-1]
 
     """
-    Similar to the normal behavior as create_partition, but with custom time steps
+    Streams XML data in chunked mode, keeping only the time span of the data.
     """
-    def _create_custom_partition(self, time_periods):
-        count = 0
-        for time_1, time_2 in time_periods:
-            region = (self.data["sys_time"] >= time_1) & (self.data["sys_time"] < time_2)
+    def scan_xml_data(self, plugin_filename, offset_ms):
+        self.row_count = 0
+        for batch, _ in self._read_batches(plugin_filename, offset_ms, self.chunk_size):
+            if self.first_time is None:
+                self.first_time = batch["sys_time"].iloc[0]
+            self.last_time = batch["sys_time"].iloc[-1]
+            self.row_count += len(batch)
 
-            if not any(list(region)):
-                continue
-
-            self.data.loc[region, "Partition"] = int(count)
-            count += 1
-
-        self.partition_count = int(self.data["Partition"].dropna().max()) + 1
+    """
+    Parses the gaze responses of a data file, and yields them in batches of chunk_size rows
+    (or all at once, if chunk_size is None). Each batch is a DataFrame indexed by row number,
+    and a numpy array of the byte offset of each response. If attributes is True, the batches
+    also have the x, y, event_time, left_pupil and right_pupil columns.
+    """
+    def _read_batches(self, plugin_filename, offset_ms, chunk_size, attributes=False):
+        parser = xml.parsers.expat.ParserCreate()
+        timestamps = list()
+        offsets = list()
+        values = dict((name, list()) for name in ["x", "y", "event_time", "left_pupil", "right_pupil"])
+
+        # The depth of the current element, the number of children of the root seen so far,
+        # and the row number of the first pending response
+        state = {"depth": 0, "children": 0, "first_row": 0}
+
+        self.gazes_start_offset = None
+        self.gazes_end_offset = None
+
+        # The gaze responses are the children of the root's second child
+        def start_element(tag, response):
+            state["depth"] += 1
+            if state["depth"] == 2:
+                state["children"] += 1
+            elif state["depth"] == 3 and state["children"] == 2:
+                timestamps.append(response['timestamp'])
+                offsets.append(parser.CurrentByteIndex)
+                if attributes:
+                    values["x"].append(float(response['x']))
+                    values["y"].append(float(response['y']))
+                    values["event_time"].append(int(response['event_time']))
+                    values["left_pupil"].append(float(response.get('left_pupil_diameter', "nan")))
+                    values["right_pupil"].append(float(response.get('right_pupil_diameter', "nan")))
+                if self.gazes_start_offset is None:
+                    self.gazes_start_offset = parser.CurrentByteIndex
+
+        def end_element(tag):
+            if state["depth"] == 2 and state["children"] == 2:
+                self.gazes_end_offset = parser.CurrentByteIndex
+                if self.gazes_start_offset is None:
+                    self.gazes_start_offset = parser.CurrentByteIndex
+            state["depth"] -= 1
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+
+        def take_batch(size):
+            first_row = state["first_row"]
+            frame = pd.DataFrame.from_dict({"fix_time": timestamps[:size],
+                                            "row_num": list(range(first_row, first_row + size))})
+            frame.index = pd.RangeIndex(first_row, first_row + size)
+
+            # Create epoch time column
+            frame["sys_time"] = timestamps_to_epoch(frame["fix_time"]) + offset_ms
+
+            if attributes:
+                for name, column in values.items():
+                    frame[name] = np.array(column[:size], dtype=np.int64 if name == "event_time" else np.float64)
+                    del column[:size]
+
+            batch_offsets = np.array(offsets[:size], dtype=np.int64)
+            del timestamps[:size]
+            del offsets[:size]
+            state["first_row"] += size
+            return frame, batch_offsets
+
+        with open(plugin_filename, "rb") as infile:
+            while True:
+                block = infile.read(READ_BLOCK_SIZE)
+                parser.Parse(block, not block)
+
+                while chunk_size is not None and len(timestamps) >= chunk_size:
+                    yield take_batch(chunk_size)
+
+                if not block:
+                    break
+
+        if chunk_size is None or len(timestamps) > 0:
+            yield take_batch(len(timestamps))
 
     """
     If used in conjunction with a saved timeline, these time parameters
@@ -102,7 +328,8 @@ class GazeDataPartition:
             )
 
         if time_periods is not None:
-            self._create_custom_partition(time_periods)
+            # Periods that contain no data do not get a partition number
+            self._create_partition(_PeriodLocator(time_periods))
             return
         else:
             if period is not None:
@@ -111,25 +338,167 @@ class GazeDataPartition:
                 times = np.linspace(self.first_time, self.last_time, num_parts + 1)
                 times = list(map(int, times))
 
-        count = 0
-        for i in range(len(times)-1):
-            time_1, time_2 = times[i:i+2]
-            self.data.loc[
-                (self.data["sys_time"] >= time_1) &
-                (self.data["sys_time"] < time_2),
-                "Partition"
-            ] = count
-            count += 1
+        self._create_partition(_StepLocator(times, after_last=period is not None))
+
+        return times[1] - times[0]
 
-        if period is not None:
-            self.data.loc[
-                self.data["sys_time"] >= times[-1],
-                "Partition"
-            ] = count
+    """
+    Assigns each row to the partition of its period, as found by a locator.
+    """
+    def _create_partition(self, locator):
+        if self.chunk_size is not None:
+            self._create_streamed_partition(locator)
+            return
 
-        self.partition_count = self.data["Partition"].max() + 1
+        period, occupied = locator.locate(self.data["sys_time"].to_numpy())
+        assigned = period >= 0
+        self._assign_partitions(locator.numbers(occupied)[period[assigned]], assigned)
 
-        return times[1] - times[0]
+        self.partition_count = int(self.data["Partition"].dropna().max()) + 1
+
+    """
+    Sets the partition of the rows selected by the boolean array assigned.
+    Other rows keep their partition (NaN if they have none).
+    """
+    def _assign_partitions(self, partitions, assigned):
+        if "Partition" not in self.data.columns:
+            self.data["Partition"] = np.nan
+
+        self.data.loc[assigned, "Partition"] = partitions
+
+    """
+    Partitions the data in chunked mode. Only the byte offsets of the first and last row of each
+    period are kept, which is all save_partition needs to write the XML files.
+    """
+    def _create_streamed_partition(self, locator):
+        occupied = np.zeros(locator.count, dtype=bool)
+        first_offsets = np.full(locator.count, -1, dtype=np.int64)
+        last_offsets = np.full(locator.count, -1, dtype=np.int64)
+
+        for batch, offsets in self._read_batches(self.data_filename, self.offset_ms, self.chunk_size):
+            period, batch_occupied = locator.locate(batch["sys_time"].to_numpy())
+            occupied |= batch_occupied
+
+            assigned = period >= 0
+            period, offsets = period[assigned], offsets[assigned]
+
+            # Batches are in row order, so a period's first row is in the first batch that has it
+            found, first = np.unique(period, return_index=True)
+            new = first_offsets[found] < 0
+            first_offsets[found[new]] = offsets[first[new]]
+
+            found, last = np.unique(period[::-1], return_index=True)
+            last_offsets[found] = offsets[::-1][last]
+
+        numbers = locator.numbers(occupied)
+        has_rows = first_offsets >= 0
+
+        self.partition_count = int(numbers[has_rows].max()) + 1
+        self.partition_offsets = dict(zip(numbers[has_rows].tolist(),
+                                          zip(first_offsets[has_rows].tolist(), last_offsets[has_rows].tolist())))
+        self._locator = locator
+        self._numbers = numbers
+
+    """
+    Returns the byte offsets of the first and last row of each partition that has data.
+    """
+    def _partition_ranges(self):
+        if self.chunk_size is not None:
+            return self.partition_offsets
+
+        rows = self.data.dropna(subset=["Partition"]).groupby("Partition")["row_num"].agg(["first", "last"])
+
+        return dict((int(number), (self.response_offsets[int(first_row)], self.response_offsets[int(last_row)]))
+                    for number, first_row, last_row in zip(rows.index, rows["first"], rows["last"]))
+
+    """
+    Returns the partition of each row of a batch (NaN for rows without one),
+    or None if the data has not been partitioned.
+    """
+    def _batch_partitions(self, batch):
+        if self.chunk_size is None:
+            if "Partition" not in self.data.columns:
+                return None
+            return self.data["Partition"].to_numpy()[batch.index]
+
+        if self._numbers is None:
+            return None
+
+        period, _ = self._locator.locate(batch["sys_time"].to_numpy())
+        return np.where(period >= 0, self._numbers[period], np.nan)
+
+    """
+    Yields the data in batches of COLUMNS (a single batch, unless in chunked mode).
+    """
+    def _column_batches(self):
+        for batch, _ in self._read_batches(self.data_filename, self.offset_ms, self.chunk_size, attributes=True):
+            partitions = self._batch_partitions(batch)
+            if partitions is None:
+                batch["Partition"] = -1
+            else:
+                batch["Partition"] = np.nan_to_num(partitions, nan=-1).astype(np.int64)
+
+            yield batch[COLUMNS].reset_index(drop=True)
+
+    """
+    Writes the columns to an uncompressed numpy archive. Each column is filled in one batch at a time
+    through a memory-mapped .npy file, and then copied into the archive.
+    """
+    def _save_npz(self, output_name):
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_name))) as temp_dir:
+            arrays = None
+            row = 0
+
+            for batch in self._column_batches():
+                if arrays is None:
+                    arrays = dict((name, np.lib.format.open_memmap(temp_dir + "/" + name + ".npy", mode="w+",
+                                                                   dtype=batch[name].dtype,
+                                                                   shape=(self.row_count,)))
+                                  for name in COLUMNS)
+
+                for name in COLUMNS:
+                    arrays[name][row:row + len(batch)] = batch[name].to_numpy()
+                row += len(batch)
+
+            for array in arrays.values():
+                array.flush()
+            del arrays
+
+            with zipfile.ZipFile(output_name, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+                for name in COLUMNS:
+                    archive.write(temp_dir + "/" + name + ".npy", arcname=name + ".npy")
+
+    """
+    Writes the columns to a Parquet file. Small batches are gathered into row groups of at least
+    PARQUET_ROW_GROUP_SIZE rows, since many small row groups are slow to read.
+    """
+    def _save_parquet(self, output_name):
+        # pyarrow is only needed for Parquet output
+        import pyarrow
+        import pyarrow.parquet
+
+        writer = None
+        pending = list()
+
+        def write_pending():
+            nonlocal writer
+            table = pyarrow.Table.from_pandas(pd.concat(pending, ignore_index=True), preserve_index=False)
+            del pending[:]
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(output_name, table.schema)
+            writer.write_table(table)
+
+        try:
+            for batch in self._column_batches():
+                pending.append(batch)
+                if sum(map(len, pending)) >= PARQUET_ROW_GROUP_SIZE:
+                    write_pending()
+
+            if pending:
+                write_pending()
+        finally:
+            if writer is not None:
+                writer.close()
 
     """
     Save the data in chunks. 
@@ -141,40 +510,97 @@ class GazeDataPartition:
             plugin files to the appropriate subdirectories.
         formatting="csv":
             save the dataframe to a CSV, with the name of the file being output_name.
+            In chunked mode, the CSV is written one batch at a time.
+        formatting="npz" or formatting="parquet":
+            save the typed COLUMNS of every row to a numpy archive or a Parquet file (which requires
+            pyarrow), with the name of the file being output_name. Use load_partition_columns to read it.
     """
     def save_partition(self, output_name, formatting="xml"):
         if formatting is "csv":
-            self.data.to_csv(output_name)
+            if self.chunk_size is None:
+                self.data.to_csv(output_name)
+                return
+
+            mode = "w"
+            for batch, _ in self._read_batches(self.data_filename, self.offset_ms, self.chunk_size):
+                partitions = self._batch_partitions(batch)
+                if partitions is not None:
+                    batch["Partition"] = partitions
+
+                batch.to_csv(output_name, mode=mode, header=mode == "w")
+                mode = "a"
+        elif formatting == "npz":
+            self._save_npz(output_name)
+        elif formatting == "parquet":
+            self._save_parquet(output_name)
         elif formatting is "xml":
-            infile = open(self.data_filename, "r")
-            xml_lines = infile.readlines()
-            infile.close()
+            # The byte offsets of the first and last row of each partition
+            ranges = self._partition_ranges()
 
-            first_line = xml_lines.index("<gazes>\n") + 1
-            suffix_line = xml_lines.index("</gazes>\n")
+            # Existing timeline directories, by partition number
+            partition_dirs = dict()
+            if os.path.isdir(output_name):
+                for name in os.listdir(output_name):
+                    number, _, label = name.partition("_")
+                    if label and "-" in label and number not in partition_dirs:
+                        partition_dirs[number] = output_name + "/" + name
 
-            for i in range(int(self.partition_count)):
-                data_part = self.data[self.data["Partition"] == i]
-                first_row = data_part.iloc[0]["row_num"]
-                last_row = data_part.iloc[-1]["row_num"]
-                lines_to_write = xml_lines[first_line + first_row: first_line + last_row]
+            # Everything before the first response, and everything from the end of the responses
+            prefix_end = self.gazes_start_offset
+            suffix_start = self.gazes_end_offset
 
-                # Find directory to write to
-                existing_partition = glob.glob(output_name+"/"+str(i)+"_*-*")
+            with open(self.data_filename, "rb") as infile:
+                source_size = os.fstat(infile.fileno()).st_size
+                source_map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
 
                 try:
-                    dir_name = existing_partition[0]
-                except IndexError:
-                    dir_name = output_name+"/"+str(i)
-                    if not os.path.isdir(dir_name):
-                        os.makedirs(dir_name)
-
-                with open(dir_name+"/plugin_log.xml", "w") as ofile:
-                    ofile.writelines(xml_lines[:first_line])
-                    ofile.writelines(lines_to_write)
-                    ofile.writelines(xml_lines[suffix_line:])
+                    for i in range(int(self.partition_count)):
+                        # The responses from the first row of the partition up to (not including) the last
+                        start, end = ranges.get(i, (prefix_end, prefix_end))
+
+                        # Find directory to write to
+                        try:
+                            dir_name = partition_dirs[str(i)]
+                        except KeyError:
+                            dir_name = output_name+"/"+str(i)
+                            if not os.path.isdir(dir_name):
+                                os.makedirs(dir_name)
+
+                        ofile = os.open(dir_name+"/plugin_log.xml", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                        try:
+                            for range_start, range_end in [(0, prefix_end), (start, end),
+                                                           (suffix_start, source_size)]:
+                                copy_byte_range(infile.fileno(), source_map, ofile, range_start, range_end)
+                        finally:
+                            os.close(ofile)
+                finally:
+                    source_map.close()
 
         else:
             raise ValueError(
-                "Parameter 'formatting' must be one of 'xml' or 'csv'."
+                "Parameter 'formatting' must be one of 'xml', 'csv', 'npz' or 'parquet'."
             )
+
+
+"""
+Loads the columnar output of GazeDataPartition.save_partition (formatting="npz" or "parquet")
+as a DataFrame. If columns is given, only those columns are read.
+"""
+
+
+def load_partition_columns(filename, columns=None):
+    with open(filename, "rb") as infile:
+        magic = infile.read(4)
+
+    if magic == b"PAR1":
+        return pd.read_parquet(filename, columns=columns)
+
+    with np.load(filename) as archive:
+        names = archive.files if columns is None else columns
+        for name in names:
+            if name not in archive.files:
+                raise ValueError(
+                    "Column not found in "+str(filename)+": "+str(name)
+                )
+
+        return pd.DataFrame.from_dict(dict((name, archive[name]) for name in names))
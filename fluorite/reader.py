@@ -3,9 +3,21 @@ A set of classes that detect and compile edits to the code.
 """
 
 import os
+import sys
 import json
-import copy
+import bisect
+import collections.abc
+import concurrent.futures
 import xml.etree.ElementTree
+import xml.parsers.expat
+from .document import Document
+from .line_ranges import LineRangeIndex
+from .object_store import ObjectStore
+from .timeline_archive import TimelineArchiveWriter, KEYFRAME_INTERVAL
+from .cache import log_file_key, load_cached_log, save_cached_log
+
+# The default number of changes between replay checkpoints stored by a FileHistory
+CHECKPOINT_INTERVAL = 256
 
 """
 A base class for edit events.
@@ -15,23 +27,34 @@ Fields:
     time_1: The time at which the change began
     repeat: A boolean describing whether or not the change is composed of multiple key events.
             (It is True if multiple key events contribute to the change).
-    changed_file: The file that was changed.
-    time_2: The time at which the change completed. May or may not be initialized depending on 
-            the value of repeat.
+    changed_file: The file that was changed. File names are interned, so all events share one copy of each.
+    time_2: The time at which the change completed. None unless repeat is True.
+
+Events are stored in __slots__ rather than a __dict__, since a long session holds hundreds of thousands of them.
 """
 
 
 class DocumentChange:
+    __slots__ = ["token_start", "time_1", "time_2", "repeat", "changed_file"]
+
     def __init__(self, token_start, start_time, changed_file, **kwargs):
         self.token_start = int(token_start)
         self.time_1 = int(start_time)
+        self.time_2 = None
         self.repeat = False
-        self.changed_file = changed_file
+        self.changed_file = sys.intern(changed_file) if type(changed_file) is str else changed_file
 
         if "end_time" in kwargs.keys() and kwargs["end_time"] is not None:
             self.time_2 = kwargs["end_time"]
             self.repeat = True
 
+    """
+    The time at which the change completed (time_2 if it is known, otherwise time_1).
+    """
+    @property
+    def end_time(self):
+        return self.time_2 if self.repeat else self.time_1
+
 
 """
 A child class describing insertions.
@@ -42,6 +65,8 @@ Fields:
 
 
 class InsertionEvent(DocumentChange):
+    __slots__ = ["string_inserted"]
+
     def __init__(self, token_start=None, start_time=None,
                  string_inserted=None, changed_file=None, **kwargs):
         DocumentChange.__init__(self, token_start, start_time, changed_file, **kwargs)
@@ -59,6 +84,8 @@ Fields:
 
 
 class DeletionEvent(DocumentChange):
+    __slots__ = ["token_end", "string_deleted"]
+
     def __init__(self, token_start=None, start_time=None,
                  token_end=None, string_deleted=None,
                  changed_file=None, **kwargs):
@@ -74,17 +101,21 @@ Fields:
     token_end: The index of the character that is one past the end of the deletion, prior to the occurrence of the
         deletion.
     replace_with: The string to insert.
+    string_replaced: The string that is replaced, or None if it is not known.
 """
 
 
 class ReplaceEvent(DocumentChange):
+    __slots__ = ["token_end", "replace_with", "string_replaced"]
+
     def __init__(self, token_start=None, start_time=None,
                  token_end=None, replace_with=None,
-                 changed_file=None, **kwargs):
+                 changed_file=None, string_replaced=None, **kwargs):
         DocumentChange.__init__(self, token_start,
                                 start_time, changed_file, **kwargs)
         self.token_end = int(token_end)
         self.replace_with = str(replace_with)
+        self.string_replaced = string_replaced
 
 
 """
@@ -97,71 +128,167 @@ Parameters:
         is the result of indexing by one of those keys).
     initial_entities: Similarly, a dictionary conforming to the format of an entity index (see the relevant example),
         for a particular file.
+    checkpoint_interval: The number of changes between stored checkpoints. Queries replay from the nearest
+        earlier checkpoint (or from the state left by the previous query) instead of from initial_content.
 """
 
 
 class FileHistory:
     def __init__(self, filename, initial_content,
-                 initial_functions=None, initial_entities=None):
+                 initial_functions=None, initial_entities=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
         self.initial_functions = initial_functions
         self.initial_entities = initial_entities
         self.filename = str(filename)
         self.initial_content = initial_content
         self.changes = list()
 
+        # The start time of each change, kept parallel to self.changes
+        self._times = list()
+
+        self.checkpoint_interval = int(checkpoint_interval)
+
+        if self.checkpoint_interval < 1:
+            raise ValueError(
+                "checkpoint_interval must be a positive integer, not "+str(checkpoint_interval)
+            )
+
+        # Replay states, kept sorted by the number of changes they include
+        self._checkpoints = list()
+        self._checkpoint_indices = list()
+
+        # The state reached by the most recent query
+        self._cursor = None
+
+        # Incremented whenever the list of changes is modified
+        self.revision = 0
+
     """
     Gets a snapshot of this file at a particular time stamp.
     Units are in milliseconds.
     Subsequent return values are new function/entity indices.
+    These indices are shared with other snapshots in which they are unchanged, so they must not be modified.
     """
     def get_snapshot(self, timestamp):
-        content = self.initial_content
-        functions = copy.deepcopy(self.initial_functions)
-        entities = copy.deepcopy(self.initial_entities)
-        for change in self.changes:
-            if timestamp < change.time_1:
-                break
+        document, functions, entities = self.get_document(timestamp)
+        return str(document), functions, entities
 
-            if type(change) is InsertionEvent:
-                content = content[:change.token_start] + \
-                    change.string_inserted + content[change.token_start:]
-
-                if functions is not None and '\n' in change.string_inserted:
-                    lines_added = change.string_inserted.count("\n")
-                    prior_string = content[:change.token_start]
-                    line_num_start = prior_string.count("\n")
-                    functions = update_functions(functions, line_num_start, lines_added)
-                    entities = update_entities(entities, line_num_start, lines_added)
-
-            elif type(change) is DeletionEvent:
-                content = content[:change.token_start] + \
-                    content[change.token_end:]
-
-                if functions is not None and '\n' in change.string_deleted:
-                    lines_removed = change.string_deleted.count("\n")
-                    prior_string = content[:change.token_start]
-                    line_num_start = prior_string.count("\n")
-                    functions = update_functions(functions, line_num_start, -1 * lines_removed)
-                    entities = update_entities(entities, line_num_start, -1 * lines_removed)
-
-            elif type(change) is ReplaceEvent:
-                string_removed = content[change.token_start: change.token_end + 1]
-                content = content[:change.token_start] + \
-                    change.replace_with + content[change.token_end:]
-
-                if functions is not None and ('\n' in string_removed or '\n' in change.replace_with):
-                    net_lines_added = change.replace_with.count("\n") - string_removed.count("\n")
-                    if net_lines_added == 0:
-                        continue
-                    prior_string = content[:change.token_start]
-                    line_num_start = prior_string.count("\n")
-                    functions = update_functions(functions, line_num_start, net_lines_added)
-                    entities = update_entities(entities, line_num_start, net_lines_added)
+    """
+    Generates a snapshot for each of many time stamps in one forward pass over the changes.
+    The time stamps are sorted, and each value generated is a tuple of
+    (time stamp, content, functions, entities) as in get_snapshot.
+    Time stamps that fall between the same pair of changes share one content string.
+    """
+    def get_snapshots(self, timestamps):
+        last_index, last_snapshot = None, None
+        for timestamp in sorted(timestamps):
+            state = self._replay(timestamp)
+
+            if state.index != last_index:
+                last_index = state.index
+                last_snapshot = (
+                    str(state.document),
+                    state.functions.to_dict() if state.functions is not None else None,
+                    state.entities.to_dict() if state.entities is not None else None
+                )
+
+            yield (timestamp,) + last_snapshot
+
+    """
+    Like get_snapshot, but returns the file as a Document instead of a string,
+    so that the text is only built if the caller needs it.
+    """
+    def get_document(self, timestamp):
+        state = self._replay(timestamp)
+        functions = state.functions.to_dict() if state.functions is not None else None
+        entities = state.entities.to_dict() if state.entities is not None else None
+        return state.document.copy(), functions, entities
+
+    """
+    Returns the number of changes that begin at or before timestamp.
+    Two snapshots with the same count (and the same revision of this history) are identical.
+    """
+    def count_changes(self, timestamp):
+        return bisect.bisect_right(self._times, timestamp)
+
+    """
+    Returns a copy of the replay state at timestamp, which seed_replay can later resume from.
+    """
+    def get_replay_state(self, timestamp):
+        return self._replay(timestamp).copy()
+
+    """
+    Makes the next query resume from a state returned by get_replay_state.
+    The state must have been taken from this history, at its current revision.
+    """
+    def seed_replay(self, state):
+        self._cursor = state
 
+    """
+    Returns the replay state containing every change that begins at or before timestamp.
+    Replay starts from the query cursor if it has not yet passed timestamp, and otherwise
+    from the latest checkpoint that has not. Checkpoints are recorded along the way.
+    """
+    def _replay(self, timestamp):
+        state = None
+        if self._cursor is not None and self._cursor.includes_only(self._times, timestamp):
+            state = self._cursor
+
+        # Find the latest checkpoint that does not pass timestamp
+        low, high = 0, len(self._checkpoints)
+        while low < high:
+            middle = (low + high) // 2
+            if self._checkpoints[middle].includes_only(self._times, timestamp):
+                low = middle + 1
             else:
-                raise AssertionError("Bad type in change list: "+str(type(change)))
+                high = middle
+
+        if low > 0 and (state is None or self._checkpoints[low - 1].index > state.index):
+            state = self._checkpoints[low - 1].copy()
+
+        if state is None:
+            state = _ReplayState(Document(self.initial_content),
+                                 self._initial_index(self.initial_functions, False),
+                                 self._initial_index(self.initial_entities, True))
+
+        while state.index < len(self.changes):
+            if timestamp < self._times[state.index]:
+                break
+
+            state.apply(self.changes[state.index])
+
+            if state.index % self.checkpoint_interval == 0:
+                self._store_checkpoint(state)
+
+        self._cursor = state
+        return state
+
+    def _initial_index(self, ranges, nested):
+        if ranges is None:
+            return None
+        return LineRangeIndex(ranges, nested=nested)
+
+    def _store_checkpoint(self, state):
+        position = bisect.bisect_left(self._checkpoint_indices, state.index)
+        if position < len(self._checkpoint_indices) and \
+                self._checkpoint_indices[position] == state.index:
+            return
+
+        self._checkpoint_indices.insert(position, state.index)
+        self._checkpoints.insert(position, state.copy())
+
+    """
+    Discards checkpoints (and the query cursor) that include the change at position index or later.
+    """
+    def _invalidate_replay(self, index):
+        self.revision += 1
+
+        position = bisect.bisect_right(self._checkpoint_indices, index)
+        del self._checkpoint_indices[position:]
+        del self._checkpoints[position:]
 
-        return content, functions, entities
+        if self._cursor is not None and self._cursor.index > index:
+            self._cursor = None
 
     """
     Updates the object by passing an XML element representing
@@ -169,14 +296,98 @@ class FileHistory:
     Guarantees that changes are sorted by starting time.
     """
     def update_history(self, change):
-        if type(change) not in [InsertionEvent, DeletionEvent, ReplaceEvent]:
-            raise ValueError(
-                "Cannot append non-event type " +
-                str(type(change))+" to FileHistory object"
-            )
+        check_event_type(change)
+
+        # Changes that start at the same time keep the order in which they were added
+        position = bisect.bisect_right(self._times, change.time_1)
+        self.changes.insert(position, change)
+        self._times.insert(position, change.time_1)
+        self._invalidate_replay(position)
 
-        self.changes.append(change)
+    """
+    Adds many changes at once, sorting the history a single time.
+    The resulting order is the same as adding each change with update_history.
+    """
+    def extend_history(self, changes):
+        changes = list(changes)
+        if len(changes) == 0:
+            return
+
+        for change in changes:
+            check_event_type(change)
+
+        position = bisect.bisect_right(self._times, min(change.time_1 for change in changes))
+        self.changes.extend(changes)
         self.changes.sort(key=lambda c: c.time_1)
+        self._times = [change.time_1 for change in self.changes]
+        self._invalidate_replay(position)
+
+
+"""
+The document and function/entity indices of a file after its first 'index' changes have been applied.
+"""
+
+
+class _ReplayState:
+    def __init__(self, document, functions, entities, index=0):
+        self.document = document
+        self.functions = functions
+        self.entities = entities
+        self.index = index
+
+    def copy(self):
+        return _ReplayState(self.document.copy(),
+                            self.functions.copy() if self.functions is not None else None,
+                            self.entities.copy() if self.entities is not None else None,
+                            self.index)
+
+    """
+    True if every change in this state begins at or before timestamp.
+    """
+    def includes_only(self, times, timestamp):
+        return self.index == 0 or times[self.index - 1] <= timestamp
+
+    def apply(self, change):
+        document = self.document
+
+        if type(change) is InsertionEvent:
+            document.insert(change.token_start, change.string_inserted)
+
+            if self.functions is not None and '\n' in change.string_inserted:
+                lines_added = change.string_inserted.count("\n")
+                line_num_start = document.line_of(change.token_start)
+                self.shift_lines(line_num_start, lines_added)
+
+        elif type(change) is DeletionEvent:
+            document.delete(change.token_start, change.token_end)
+
+            if self.functions is not None and '\n' in change.string_deleted:
+                lines_removed = change.string_deleted.count("\n")
+                line_num_start = document.line_of(change.token_start)
+                self.shift_lines(line_num_start, -1 * lines_removed)
+
+        elif type(change) is ReplaceEvent:
+            string_removed = document.slice(change.token_start, change.token_end + 1)
+            document.replace(change.token_start, change.token_end, change.replace_with)
+
+            if self.functions is not None and ('\n' in string_removed or '\n' in change.replace_with):
+                net_lines_added = change.replace_with.count("\n") - string_removed.count("\n")
+                if net_lines_added != 0:
+                    line_num_start = document.line_of(change.token_start)
+                    self.shift_lines(line_num_start, net_lines_added)
+
+        else:
+            raise AssertionError("Bad type in change list: "+str(type(change)))
+
+        self.index += 1
+
+    """
+    Moves the functions and entities that follow first_line by net_added lines.
+    """
+    def shift_lines(self, first_line, net_added):
+        self.functions.shift(first_line, net_added)
+        if self.entities is not None:
+            self.entities.shift(first_line, net_added)
 
 
 """
@@ -190,11 +401,24 @@ Parameters:
         regenerated and returned with each call to get_snapshot().
         
     entity_location_file: Similar to the above, but for an entity index.
+
+    cache_dir: If given, a directory in which parsed logs are cached, keyed by the hash and size of
+        the log file. A log that is already in the cache is loaded from it instead of being parsed.
+        After construction, cache_status is "hit" or "miss" (or None if no cache is used).
+
+    lazy: If True, construction only indexes the log, and the history of each file is parsed
+        the first time that file is used. Cannot be combined with cache_dir.
 """
 
 
 class ProjectHistory:
-    def __init__(self, logfile, func_location_file=None, entity_location_file=None):
+    def __init__(self, logfile, func_location_file=None, entity_location_file=None, cache_dir=None,
+                 lazy=False):
+        if lazy and cache_dir is not None:
+            raise ValueError(
+                "Parameters 'lazy' and 'cache_dir' cannot be used together"
+            )
+
         self.logfile = logfile
         self.initial_functions = self.initial_entities = None
 
@@ -211,7 +435,17 @@ class ProjectHistory:
         self.launch_time = None
         self.line_separator = None
 
-        self.parse_logfile()
+        self.cache_dir = cache_dir
+        self.cache_status = None
+
+        self.lazy = lazy
+
+        if lazy:
+            self.index_logfile()
+        elif cache_dir is None:
+            self.parse_logfile()
+        else:
+            self.load_logfile_from_cache()
 
     """
     Get a snapshot of a given file at a particular time stamp.
@@ -229,180 +463,241 @@ class ProjectHistory:
                 .get_snapshot(timestamp)
 
     """
-    Parse the log file. (Only performed on construction).
+    Get a given file at a particular time stamp as a Document, along with function/entity positions if any.
+    The Document converts between character offsets and (line, column) positions.
     """
-    def parse_logfile(self):
-        tree = xml.etree.ElementTree.parse(self.logfile)
-        root = tree.getroot()
-
-        # Get time at which the IDE was launched.
-        self.launch_time = int(root.attrib['startTimestamp'])
+    def get_document(self, filename, timestamp):
+        if filename not in self.project_files.keys():
+            raise ValueError(
+                "No mention of "+str(filename)+" is "
+                "made in the log file "+str(self.logfile)
+            )
 
-        # Get line separator and un-escape it.
-        self.line_separator = root.attrib['lineSeparator']\
-            .replace("\\n", "\n")\
-            .replace("\\r", "\r")
+        return self.project_files[filename].get_document(timestamp)
 
-        if self.line_separator != "\r\n" and self.line_separator != "\n":
-            raise NotImplementedError(
-                "Line separator not supported: "+root.attrib['lineSeparator'] +
-                "\nPlease report this issue."
+    """
+    Get snapshots of a given file at many time stamps, in a single pass over its history.
+    Returns a generator of (time stamp, snapshot, functions, entities) tuples, sorted by time stamp.
+    """
+    def get_snapshots(self, filename, timestamps):
+        if filename not in self.project_files.keys():
+            raise ValueError(
+                "No mention of "+str(filename)+" is "
+                "made in the log file "+str(self.logfile)
             )
 
+        return self.project_files[filename].get_snapshots(timestamps)
+
+    """
+    Parse the log file. (Only performed on construction).
+    The log is streamed, so only one logged item is held in memory at a time.
+    """
+    def parse_logfile(self):
+        elements = iterparse_log(self.logfile)
+        root = next(elements)
+        self.launch_time, self.line_separator = read_log_attributes(root.attrib)
+
+        # Changes for each file, added to its history in one batch once the log has been read
+        pending_changes = dict()
+
         # Iterate over logged items:
         current_file = None
-        for child in root:
+        for child in elements:
 
             # Parse FileOpenCommand elements
             if child.tag == "Command" and \
                     child.attrib["_type"] == "FileOpenCommand":
-                snapshot_text = None
-                for grandchild in child:
+                current_file, snapshot_text = parse_file_open(child, current_file, self.line_separator)
 
-                    if grandchild.tag == "filePath":
-                        current_file = grandchild.text
+                if snapshot_text is not None:
+                    # Construct FileHistory object from file snapshot and file name
+                    short_name = trim_filepath(current_file)
+                    self.project_files[short_name] = self._new_file_history(short_name, snapshot_text)
+                    pending_changes[short_name] = list()
 
-                    elif grandchild.tag == "snapshot":
-                        if grandchild.text is None:
-                            snapshot_text = ""
-                        else:
-                            snapshot_text = grandchild.text
+            # Parse DocumentChange elements
+            elif child.tag == "DocumentChange":
+                change = parse_document_change(child, current_file,
+                                               self.launch_time, self.line_separator)
+                if change is not None:
+                    pending_changes[trim_filepath(current_file)].append(change)
 
-                if current_file is None:
-                    raise ValueError(
-                        "Filepath tag not found in Command with attribute _type=FileOpenCommand."
-                        " (This is the minimal content for a legal tag of this type)."
-                    )
+            else:
+                continue  # ELSE: tag is neither of 'DocumentChange' or 'FileOpenCommand'
 
-                # Adjust snapshot text to match real text
-                if snapshot_text is not None:
-                    snapshot_text = snapshot_text.replace("\n", self.line_separator)
+        for short_name, changes in pending_changes.items():
+            self.project_files[short_name].extend_history(changes)
 
-                    # Construct FileHistory object from file snapshot and file name
-                    short_name = trim_filepath(current_file)
-                    short_name_no_ext = trim_extension(short_name)
+    """
+    Index the log file by file, without parsing the content of any logged item. (Only performed on
+    construction, in lazy mode). The history of a file is parsed when it is first requested.
+    """
+    def index_logfile(self):
+        root_attributes, encoding, file_elements = index_log(self.logfile)
+        self.launch_time, self.line_separator = read_log_attributes(root_attributes)
 
-                    if not self.initial_functions or short_name_no_ext not in self.initial_functions.keys():
-                        init_funcs = None
-                    else:
-                        init_funcs = self.initial_functions[trim_extension(short_name)]
+        # Logged items are parsed on their own, so they need the declared encoding of the log
+        self._fragment_prefix = b""
+        if encoding is not None:
+            self._fragment_prefix = ('<?xml version="1.0" encoding="' + encoding + '"?>').encode(encoding)
 
-                    if not self.initial_entities or short_name_no_ext not in self.initial_entities:
-                        init_entities = None
-                    else:
-                        init_entities = self.initial_entities[trim_extension(short_name)]
+        self.project_files = _LazyFileHistories(self, file_elements)
 
-                    self.project_files[short_name] = \
-                        FileHistory(short_name, snapshot_text,
-                                    initial_functions=init_funcs,
-                                    initial_entities=init_entities)
+    """
+    Builds the FileHistory of a file from the byte ranges of its logged items (see index_log).
+    """
+    def _load_file_history(self, short_name, elements):
+        filehist = None
+        changes = list()
+
+        with open(self.logfile, "rb") as infile:
+            for start, end, current_file in elements:
+                infile.seek(start)
+                child = xml.etree.ElementTree.fromstring(self._fragment_prefix + infile.read(end - start))
+
+                if filehist is None:
+                    _, snapshot_text = parse_file_open(child, current_file, self.line_separator)
+                    filehist = self._new_file_history(short_name, snapshot_text)
+                else:
+                    change = parse_document_change(child, current_file,
+                                                   self.launch_time, self.line_separator)
+                    if change is not None:
+                        changes.append(change)
 
-            # Parse DocumentChange elements
-            elif child.tag == "DocumentChange":
-                if current_file is None:
-                    raise ValueError(
-                        "Bad format: A DocumentChange element appeared "
-                        "before any FileOpenCommand was registered."
-                    )
+        filehist.extend_history(changes)
+        return filehist
 
-                time_2 = None
-                if 'timestamp2' in child.attrib.keys():
-                    time_2 = self.launch_time + int(child.attrib['timestamp2'])
-
-                if child.attrib['_type'] == "Delete":
-                    sd = child[0].text.replace("\n", self.line_separator)
-                    change = DeletionEvent(
-                        token_start=int(child.attrib['offset']),
-                        start_time=self.launch_time + int(child.attrib['timestamp']),
-                        token_end=int(child.attrib['offset']) + int(child.attrib['length']),
-                        changed_file=current_file,
-                        string_deleted=sd,
-                        end_time=time_2
-                    )
+    """
+    Creates an empty FileHistory, with the initial function/entity indices of the given file (if any).
+    """
+    def _new_file_history(self, short_name, snapshot_text):
+        short_name_no_ext = trim_extension(short_name)
 
-                elif child.attrib['_type'] == "Insert":
-                    si = child[0].text.replace("\n", self.line_separator)
-                    change = InsertionEvent(
-                        token_start=int(child.attrib['offset']),
-                        start_time=self.launch_time + int(child.attrib['timestamp']),
-                        string_inserted=si,
-                        changed_file=current_file,
-                        end_time=time_2
-                    )
+        if not self.initial_functions or short_name_no_ext not in self.initial_functions.keys():
+            init_funcs = None
+        else:
+            init_funcs = self.initial_functions[short_name_no_ext]
 
-                elif child.attrib['_type'] == "Replace":
-                    rw = child[1].text
-                    if rw is not None:
-                        rw = rw.replace("\n", self.line_separator)
-                    else:
-                        rw = ""
-                    change = ReplaceEvent(
-                        token_start=int(child.attrib['offset']),
-                        start_time=self.launch_time + int(child.attrib['timestamp']),
-                        token_end=int(child.attrib['offset']) + int(child.attrib['length']),
-                        replace_with=rw,
-                        changed_file=current_file,
-                        end_time=time_2
-                    )
+        if not self.initial_entities or short_name_no_ext not in self.initial_entities:
+            init_entities = None
+        else:
+            init_entities = self.initial_entities[short_name_no_ext]
 
-                else:
-                    continue
+        return FileHistory(short_name, snapshot_text,
+                           initial_functions=init_funcs,
+                           initial_entities=init_entities)
 
-                self.project_files[trim_filepath(current_file)].update_history(change)
+    """
+    Loads the parsed log from the cache if possible; otherwise parses it and caches the result.
+    Only the content of the log is cached. Function and entity indices are applied after loading,
+    so the same entry serves any index files.
+    """
+    def load_logfile_from_cache(self):
+        key = log_file_key(self.logfile)
+        cached = load_cached_log(self.cache_dir, key)
 
-            else:
-                continue  # ELSE: tag is neither of 'DocumentChange' or 'FileOpenCommand'
+        if cached is not None:
+            self.cache_status = "hit"
+            self.launch_time = cached["launch_time"]
+            self.line_separator = cached["line_separator"]
+
+            for short_name, initial_content, changes in cached["files"]:
+                self.project_files[short_name] = self._new_file_history(short_name, initial_content)
+                self.project_files[short_name].extend_history(changes)
+            return
+
+        self.cache_status = "miss"
+        self.parse_logfile()
+
+        save_cached_log(self.cache_dir, key, {
+            "launch_time": self.launch_time,
+            "line_separator": self.line_separator,
+            "files": [(short_name, filehist.initial_content, filehist.changes)
+                      for short_name, filehist in self.project_files.items()]
+        })
 
     """
     Returns a list of change objects for the entire project.
+    If an EditCoalescer is given as coalesce, returns its list of edit bursts instead.
     """
 
-    def get_all_changes(self):
+    def get_all_changes(self, coalesce=None):
         # Form global change list
         all_changes = list()
         for filehist in self.project_files.values():
             all_changes.extend(filehist.changes)
 
-        return sorted(all_changes, key=lambda c: c.time_1)
+        all_changes.sort(key=lambda c: c.time_1)
+
+        if coalesce is not None:
+            return coalesce.coalesce(all_changes)
+
+        return all_changes
 
     """
     Saves snapshots of all files that were ever opened at target_time.
     The parameters start_time and end_time are for display purposes only.
     They form the name of the output directory, preceded by output_prefix.
+    If an ObjectStore is given, each file is written to the store once and linked into
+    the output directory, and a manifest of the linked objects is saved alongside code_files.
     """
 
-    def save_snapshots(self, start_time, end_time, target_time, output_prefix):
-        target_dir = output_prefix + "/" + str(start_time) + \
-                     "-" + str(end_time) + "/code_files"
+    def save_snapshots(self, start_time, end_time, target_time, output_prefix, object_store=None):
+        period_dir = output_prefix + "/" + str(start_time) + \
+                     "-" + str(end_time)
+        target_dir = period_dir + "/code_files"
 
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
 
+        manifest = dict()
+
+        for name, key, text in self.snapshot_files(target_time):
+            if object_store is None:
+                with open(target_dir + "/" + name, "w") as ofile:
+                    ofile.write(text() if callable(text) else text)
+            else:
+                digest = object_store.put(text, key=key)
+                object_store.link(digest, target_dir + "/" + name)
+                manifest["code_files/" + name] = digest
+
+        if object_store is not None:
+            with open(period_dir + "/manifest.json", "w") as ofile:
+                json.dump(manifest, ofile, indent=1)
+
+    """
+    Returns the files that save_snapshots writes for target_time, as a list of (file name, key, text)
+    triples. The text of a code file is a callable that builds it, and its key is equal for two
+    time stamps (of the same ProjectHistory) only if the file is identical at both.
+    The key of functions.json and entities.json is None.
+    """
+    def snapshot_files(self, target_time):
+        files = list()
         all_functions, all_entities = dict(), dict()
 
         for filehist in self.project_files.values():
             short_filename = trim_filepath(filehist.filename)
             fname_no_ext = trim_extension(short_filename)
-            snapshot, functions, entities = filehist.get_snapshot(target_time)
-            snapshot = snapshot.replace(self.line_separator, "\n")
+            document, functions, entities = filehist.get_document(target_time)
 
-            with open(target_dir + "/" + short_filename, "w") as ofile:
-                ofile.write(snapshot)
+            # The text only needs to be built when this state of the file has not been stored yet
+            files.append((short_filename,
+                          (id(filehist), filehist.revision, filehist.count_changes(target_time)),
+                          lambda document=document: str(document).replace(self.line_separator, "\n")))
 
             if functions is not None:
-                all_functions[fname_no_ext] = copy.deepcopy(functions)
+                all_functions[fname_no_ext] = functions
 
             if entities is not None:
-                all_entities[fname_no_ext] = copy.deepcopy(entities)
+                all_entities[fname_no_ext] = entities
 
         if self.initial_functions is not None:
-            with open(target_dir + "/functions.json", "w") as ofile:
-                json.dump(all_functions, ofile)
+            files.append(("functions.json", None, json.dumps(all_functions)))
 
         if self.initial_entities is not None:
-            with open(target_dir + "/entities.json", "w") as ofile:
-                json.dump(all_entities, ofile)
+            files.append(("entities.json", None, json.dumps(all_entities)))
 
+        return files
 
     """
     Save a file timeline. Granularity is finest by default, meaning
@@ -410,24 +705,65 @@ class ProjectHistory:
     granularity, specify 'granularity' as an integer describing milliseconds. 
     This will require that you enter the first and last times you 
     wish to represent.
+    To store each distinct file only once, set 'link' to "hard" or "symbolic". Files are then
+    kept in an 'objects' directory and linked into each frame (see ObjectStore).
+    To save frames in parallel, set 'workers' to the number of processes to use.
+    The returned periods are the same for any number of workers.
+    To create a frame per burst of edits instead of per edit, set 'coalesce' to an EditCoalescer
+    (finest granularity only). Each period then starts when its burst starts, so that it covers the time
+    spent editing, and its frame shows the files as they are after the burst.
     """
     def save_timeline(self, directory_path, granularity="finest",
-                      first_time=None, last_time=None):
+                      first_time=None, last_time=None, link=None, workers=None, coalesce=None):
         # Create directory if not already present
         if not os.path.isdir(directory_path):
             os.makedirs(directory_path)
 
+        object_store = None
+        if link is not None:
+            object_store = ObjectStore(directory_path + "/objects", link=link)
+
+        frames, periods = self._timeline_frames(granularity, first_time, last_time, coalesce)
+        self._save_frames(directory_path, frames, object_store, workers)
+
+        return periods
+
+    """
+    Save a file timeline to a single archive file instead of a directory tree (see TimelineArchiveWriter).
+    The parameters granularity, first_time, last_time and coalesce are as for save_timeline, and so is the
+    return value. Each period is stored under the name of its directory in a save_timeline tree,
+    and TimelineArchive.extract rebuilds that directory's code_files.
+    """
+    def save_timeline_archive(self, archive_path, granularity="finest", first_time=None, last_time=None,
+                              keyframe_interval=KEYFRAME_INTERVAL, coalesce=None):
+        frames, periods = self._timeline_frames(granularity, first_time, last_time, coalesce)
+
+        with TimelineArchiveWriter(archive_path, keyframe_interval) as writer:
+            for start_label, end_label, target_time in frames:
+                writer.add_period(str(start_label) + "-" + str(end_label), self.snapshot_files(target_time))
+
+        return periods
+
+    """
+    Returns the (start label, end label, target time) frames of a timeline, and its periods
+    (which are None unless granularity is "finest").
+    """
+    def _timeline_frames(self, granularity, first_time, last_time, coalesce=None):
         if granularity is "finest":
             if first_time is None or last_time is None:
                 raise ValueError(
                     "Both first_time and last_time must be specified for the given option "
                     "granularity='finest'"
                 )
-            return self._save_full_timeline(directory_path, int(first_time), int(last_time))
+            return self._full_timeline_frames(int(first_time), int(last_time), coalesce)
+
+        elif coalesce is not None:
+            raise ValueError(
+                "Parameter 'coalesce' is only supported with granularity='finest'"
+            )
 
         elif type(granularity) is int:
-            self._save_periodic_timeline(directory_path, granularity,
-                                         first_time, last_time)
+            return self._periodic_timeline_frames(granularity, first_time, last_time), None
 
         else:
             raise ValueError(
@@ -435,9 +771,9 @@ class ProjectHistory:
             )
 
     """
-    Save timeline at a given granularity
+    Frames of a timeline at a given granularity
     """
-    def _save_periodic_timeline(self, directory_path, time_step, first_time, last_time):
+    def _periodic_timeline_frames(self, time_step, first_time, last_time):
         if first_time is None or last_time is None:
             raise ValueError(
                 "Time parameters must be integers representing milliseconds."
@@ -446,100 +782,425 @@ class ProjectHistory:
         # Get list of time steps
         times = list(range(int(first_time), int(last_time), int(time_step)))
 
+        # Each frame is a (start label, end label, target time) triple for save_snapshots
+        frames = list()
+
         count = 0
         for i in range(len(times)-1):
             this_time, next_time = times[i:i+2]
-            self.save_snapshots(str(count) + "_" + str(this_time), next_time,
-                                this_time+1, directory_path)
+            frames.append((str(count) + "_" + str(this_time), next_time, this_time+1))
             count += 1
 
-        self.save_snapshots(str(count) + "_" + str(times[-1]), "inf",
-                            times[-1]+1, directory_path)
+        frames.append((str(count) + "_" + str(times[-1]), "inf", times[-1]+1))
+
+        return frames
 
     """
-    Save timeline at finest granularity
+    Frames and periods of a timeline at finest granularity (or with a frame per burst of edits).
+    A period normally runs from the end of one change to the start of the next. A burst period
+    instead runs from the start of its burst to the start of the next, so the bursts are covered too.
     """
-    def _save_full_timeline(self, directory_path, first_time, last_time):
+    def _full_timeline_frames(self, first_time, last_time, coalesce=None):
         # Get global change list
-        all_changes = self.get_all_changes()
+        all_changes = self.get_all_changes(coalesce)
+
+        # The time at which the period after a change (or burst) starts
+        if coalesce is not None:
+            period_start = lambda change: change.time_1
+        else:
+            period_start = lambda change: change.end_time
 
         count = 1
 
         periods = list()
+        frames = list()
 
         if len(all_changes) > 0:
             # Save initial change
-            self.save_snapshots("0_" + str(first_time), all_changes[0].time_1, 0, directory_path)
+            frames.append(("0_" + str(first_time), all_changes[0].time_1, 0))
             periods.append([first_time, all_changes[0].time_1])
         else:
-            self.save_snapshots("0_"+str(first_time), "inf", 0, directory_path)
-            return [[first_time, last_time]]
+            return [("0_"+str(first_time), "inf", 0)], [[first_time, last_time]]
 
         # Loop through consecutive pairs of changes
         for i in range(len(all_changes)-1):
             this_change, next_change = all_changes[i:i+2]
 
-            try:
-                snapshot_start = this_change.time_2
-            except AttributeError:
-                snapshot_start = this_change.time_1
-
+            snapshot_start = period_start(this_change)
             snapshot_end = next_change.time_1
 
-            self.save_snapshots(str(count) + "_" + str(snapshot_start),
-                                snapshot_end, snapshot_start+1, directory_path)
+            frames.append((str(count) + "_" + str(snapshot_start),
+                           snapshot_end, this_change.end_time+1))
 
             periods.append([snapshot_start, snapshot_end])
 
             if snapshot_end >= last_time:
-                return periods
+                break
 
             count += 1
 
-        # Save final state
-        try:
-            final_time = all_changes[-1].time_2
-        except AttributeError:
-            final_time = all_changes[-1].time_1
+        else:
+            # Save final state
+            final_time = period_start(all_changes[-1])
 
-        self.save_snapshots(str(count) + "_" + str(final_time),
-                            last_time, final_time+1, directory_path)
+            frames.append((str(count) + "_" + str(final_time),
+                           last_time, all_changes[-1].end_time+1))
 
-        periods.append([final_time, last_time])
+            periods.append([final_time, last_time])
 
-        return periods
+        return frames, periods
+
+    """
+    Saves the snapshots for a list of (start label, end label, target time) frames.
+    With more than one worker, the frames are split into contiguous ranges that are saved
+    by a pool of processes. Each range starts from the file states at its first frame, which
+    are found here in a single pass, so no worker has to replay the history before its range.
+    """
+    def _save_frames(self, directory_path, frames, object_store=None, workers=None):
+        if workers is None or workers <= 1 or len(frames) < 2:
+            for start_label, end_label, target_time in frames:
+                self.save_snapshots(start_label, end_label, target_time, directory_path, object_store)
+            return
+
+        range_size = -(-len(frames) // workers)
+        tasks = list()
+        for first in range(0, len(frames), range_size):
+            frame_range = frames[first:first + range_size]
+            seeds = dict((name, filehist.get_replay_state(frame_range[0][2]))
+                         for name, filehist in self.project_files.items())
+            tasks.append((directory_path, frame_range, object_store, seeds))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=_init_timeline_worker,
+                                                    initargs=(self,)) as pool:
+            # Consume the results so that errors in workers are raised here
+            for _ in pool.map(_save_frame_range, tasks):
+                pass
+
+
+"""
+The FileHistory objects of a lazily loaded ProjectHistory, by short file name.
+Each FileHistory is built from the indexed elements of its file when it is first looked up.
+Membership tests and iteration over names do not build anything.
+"""
+
+
+class _LazyFileHistories(collections.abc.Mapping):
+    def __init__(self, history, file_elements):
+        self._history = history
+        self._file_elements = file_elements
+        self._loaded = dict()
+
+    def __getitem__(self, short_name):
+        if short_name not in self._loaded:
+            self._loaded[short_name] = self._history._load_file_history(
+                short_name, self._file_elements[short_name]
+            )
+        return self._loaded[short_name]
+
+    def __contains__(self, short_name):
+        return short_name in self._file_elements
+
+    def __iter__(self):
+        return iter(self._file_elements)
+
+    def __len__(self):
+        return len(self._file_elements)
+
+
+"""
+Each process in a timeline worker pool holds its own copy of the ProjectHistory.
+"""
+
+_timeline_worker_history = None
 
 
+def _init_timeline_worker(history):
+    global _timeline_worker_history
+    _timeline_worker_history = history
+
+
+def _save_frame_range(task):
+    directory_path, frames, object_store, seeds = task
+    history = _timeline_worker_history
+
+    for name, state in seeds.items():
+        history.project_files[name].seed_replay(state)
+
+    for start_label, end_label, target_time in frames:
+        history.save_snapshots(start_label, end_label, target_time, directory_path, object_store)
+
+
+"""
+Raises a ValueError if change is not one of the event types that a FileHistory can replay.
+"""
+
+
+def check_event_type(change):
+    if type(change) not in [InsertionEvent, DeletionEvent, ReplaceEvent]:
+        raise ValueError(
+            "Cannot append non-event type " +
+            str(type(change))+" to FileHistory object"
+        )
+
+
+"""
+Reads the attributes of the root element of a FLUORITE log.
+Returns the time at which the IDE was launched, and the line separator of the log.
+"""
+
+
+def read_log_attributes(attributes):
+    # Get time at which the IDE was launched.
+    launch_time = int(attributes['startTimestamp'])
+
+    # Get line separator and un-escape it.
+    line_separator = attributes['lineSeparator']\
+        .replace("\\n", "\n")\
+        .replace("\\r", "\r")
+
+    if line_separator != "\r\n" and line_separator != "\n":
+        raise NotImplementedError(
+            "Line separator not supported: "+attributes['lineSeparator'] +
+            "\nPlease report this issue."
+        )
+
+    return launch_time, line_separator
+
+
+"""
+Reads a FileOpenCommand element. Returns the path of the file that is open afterwards, and the
+snapshot of that file with the given line separator (or None if the element holds no snapshot).
+"""
+
+
+def parse_file_open(child, current_file, line_separator):
+    snapshot_text = None
+    for grandchild in child:
+
+        if grandchild.tag == "filePath":
+            current_file = grandchild.text
+
+        elif grandchild.tag == "snapshot":
+            if grandchild.text is None:
+                snapshot_text = ""
+            else:
+                snapshot_text = grandchild.text
+
+    if current_file is None:
+        raise ValueError(
+            "Filepath tag not found in Command with attribute _type=FileOpenCommand."
+            " (This is the minimal content for a legal tag of this type)."
+        )
+
+    # Adjust snapshot text to match real text
+    if snapshot_text is not None:
+        snapshot_text = snapshot_text.replace("\n", line_separator)
+
+    return current_file, snapshot_text
+
+
+"""
+Reads a DocumentChange element of the file at current_file, in a log launched at launch_time.
+Returns the change event, or None if the element is not an insertion, deletion or replacement.
 """
-A pair of utility functions to determine the positions of functions or entities after a change.
+
+
+def parse_document_change(child, current_file, launch_time, line_separator):
+    if current_file is None:
+        raise ValueError(
+            "Bad format: A DocumentChange element appeared "
+            "before any FileOpenCommand was registered."
+        )
+
+    time_2 = None
+    if 'timestamp2' in child.attrib.keys():
+        time_2 = launch_time + int(child.attrib['timestamp2'])
+
+    if child.attrib['_type'] == "Delete":
+        sd = child[0].text.replace("\n", line_separator)
+        return DeletionEvent(
+            token_start=int(child.attrib['offset']),
+            start_time=launch_time + int(child.attrib['timestamp']),
+            token_end=int(child.attrib['offset']) + int(child.attrib['length']),
+            changed_file=current_file,
+            string_deleted=sd,
+            end_time=time_2
+        )
+
+    elif child.attrib['_type'] == "Insert":
+        si = child[0].text.replace("\n", line_separator)
+        return InsertionEvent(
+            token_start=int(child.attrib['offset']),
+            start_time=launch_time + int(child.attrib['timestamp']),
+            string_inserted=si,
+            changed_file=current_file,
+            end_time=time_2
+        )
+
+    elif child.attrib['_type'] == "Replace":
+        rw = child[1].text
+        if rw is not None:
+            rw = rw.replace("\n", line_separator)
+        else:
+            rw = ""
+        rt = child[0].text
+        if rt is not None:
+            rt = rt.replace("\n", line_separator)
+        else:
+            rt = ""
+        return ReplaceEvent(
+            token_start=int(child.attrib['offset']),
+            start_time=launch_time + int(child.attrib['timestamp']),
+            token_end=int(child.attrib['offset']) + int(child.attrib['length']),
+            replace_with=rw,
+            string_replaced=rt,
+            changed_file=current_file,
+            end_time=time_2
+        )
+
+    return None
+
+
 """
+Streams the top-level elements of a FLUORITE log.
+The root element is yielded first, while it still holds its attributes. Each logged item
+is then yielded once it has been completely parsed, and is discarded when the next one is requested.
+"""
+
+
+def iterparse_log(logfile):
+    events = xml.etree.ElementTree.iterparse(logfile, events=("start", "end"))
+    _, root = next(events)
+    yield root
+
+    depth = 0
+    for event, element in events:
+        if event == "start":
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 0:
+            yield element
+            root.clear()
+
+
+"""
+Indexes a FLUORITE log by file without building any elements, so that the history of one file
+can later be parsed on its own.
+Returns the attributes of the root element, the encoding declared by the log (or None), and a
+dictionary from short file names to the (start, end, file path) byte ranges of the logged items
+that make up each file's history: the FileOpenCommand holding its latest snapshot, followed by
+its DocumentChange elements. The file path is the path of the file open at that item.
+Raises the same errors as ProjectHistory.parse_logfile for items that are out of order.
+"""
+
 
+def index_log(logfile):
+    parser = xml.parsers.expat.ParserCreate()
+    root_attributes = dict()
+    encoding = None
+    file_elements = dict()
 
-def update_functions(functions, first_line, net_added):
-    if functions is None:
-        return functions
+    depth = 0
+    current_file = None
 
-    for name, line_range in functions.items():
-        if line_range[0] > first_line:
-            line_range[0] += net_added
-        if line_range[1] >= first_line:
-            line_range[1] += net_added
+    # The (tag, _type, start, has snapshot) of the logged item being read
+    item = None
+
+    # Text of the filePath element being read, if any
+    path_text = None
+
+    # A logged item that has been read, but whose end offset is not known yet: the item
+    # ends where the next parser event begins, which also covers empty elements
+    unfinished = None
+
+    def finish_item():
+        nonlocal unfinished
+        if unfinished is None:
+            return
+
+        short_name, start, path, is_snapshot = unfinished
+        unfinished = None
+        if path_text is None:
+            parser.CharacterDataHandler = None
+
+        if is_snapshot:
+            file_elements[short_name] = [(start, parser.CurrentByteIndex, path)]
+        else:
+            file_elements[short_name].append((start, parser.CurrentByteIndex, path))
+
+    def declaration(version, declared_encoding, standalone):
+        nonlocal encoding
+        encoding = declared_encoding
+
+    def start_element(tag, attributes):
+        nonlocal depth, item, path_text
+        finish_item()
+
+        if depth == 0:
+            root_attributes.update(attributes)
+        elif depth == 1:
+            item = [tag, attributes.get("_type"), parser.CurrentByteIndex, False]
+        elif depth == 2 and item[0] == "Command" and item[1] == "FileOpenCommand":
+            if tag == "filePath":
+                path_text = list()
+                parser.CharacterDataHandler = characters
+            elif tag == "snapshot":
+                item[3] = True
+
+        depth += 1
+
+    def end_element(tag):
+        nonlocal depth, current_file, path_text, unfinished
+        finish_item()
+        depth -= 1
+
+        if depth == 2 and path_text is not None:
+            current_file = "".join(path_text) or None
+            path_text = None
+            parser.CharacterDataHandler = None
+
+        elif depth == 1:
+            tag, item_type, start, has_snapshot = item
+
+            if tag == "Command" and item_type == "FileOpenCommand":
+                if current_file is None:
+                    raise ValueError(
+                        "Filepath tag not found in Command with attribute _type=FileOpenCommand."
+                        " (This is the minimal content for a legal tag of this type)."
+                    )
+                if has_snapshot:
+                    unfinished = (trim_filepath(current_file), start, current_file, True)
+
+            elif tag == "DocumentChange":
+                if current_file is None:
+                    raise ValueError(
+                        "Bad format: A DocumentChange element appeared "
+                        "before any FileOpenCommand was registered."
+                    )
+                if item_type in ["Delete", "Insert", "Replace"]:
+                    unfinished = (trim_filepath(current_file), start, current_file, False)
 
-    return functions
+            if unfinished is not None:
+                parser.CharacterDataHandler = characters
 
+    def characters(data):
+        finish_item()
+        if path_text is not None:
+            path_text.append(data)
 
-def update_entities(entities, first_line, net_added):
-    if entities is None:
-        return entities
+    parser.XmlDeclHandler = declaration
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CommentHandler = lambda data: finish_item()
+    parser.ProcessingInstructionHandler = lambda target, data: finish_item()
 
-    for key, val in entities.items():
-        for name, line_range in val.items():
-            if line_range[0] > first_line:
-                line_range[0] += net_added
-            if line_range[1] >= first_line:
-                line_range[1] += net_added
+    with open(logfile, "rb") as infile:
+        parser.ParseFile(infile)
 
-    return entities
+    return root_attributes, encoding, file_elements
 
 
 """
@@ -0,0 +1,240 @@
+"""
+A project history that spans several FLUORITE logs, such as the sessions recorded for one participant.
+"""
+
+import heapq
+import bisect
+from .reader import FileHistory, ProjectHistory, iterparse_log, read_log_attributes, \
+    parse_file_open, parse_document_change, trim_filepath
+
+"""
+The history of a file across several sessions, as a sequence of FileHistory segments.
+
+A segment begins whenever a session opens the file with content that differs from the
+replayed content at that time. Each segment continues from the function/entity indices that
+the previous segment reached, and a session that edits the file without a snapshot of it
+continues the latest segment. Queries are answered by the latest segment that began at or
+before the time stamp (or by the first segment, for earlier time stamps).
+
+Provides the queries of FileHistory that ProjectHistory relies on.
+
+Parameters:
+    filename: the name of the file that a history is being recorded for
+"""
+
+
+class SessionFileHistory:
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.segments = list()
+
+        # The time at which each segment begins, kept parallel to self.segments
+        self._starts = list()
+
+    """
+    All changes of every segment, in order.
+    """
+    @property
+    def changes(self):
+        return [change for segment in self.segments for change in segment.changes]
+
+    """
+    Incremented whenever the list of changes of any segment is modified.
+    """
+    @property
+    def revision(self):
+        return sum(segment.revision for segment in self.segments)
+
+    """
+    Starts a new segment at start_time.
+    """
+    def add_segment(self, start_time, segment):
+        if len(self._starts) > 0 and start_time < self._starts[-1]:
+            raise ValueError(
+                "Segment of "+self.filename+" at "+str(start_time)+" begins before the latest segment"
+            )
+
+        self.segments.append(segment)
+        self._starts.append(start_time)
+
+    def get_snapshot(self, timestamp):
+        return self._segment(timestamp).get_snapshot(timestamp)
+
+    def get_document(self, timestamp):
+        return self._segment(timestamp).get_document(timestamp)
+
+    """
+    Generates (time stamp, content, functions, entities) tuples sorted by time stamp,
+    with one forward pass over each segment.
+    """
+    def get_snapshots(self, timestamps):
+        timestamps = sorted(timestamps)
+        first = 0
+        while first < len(timestamps):
+            position = self._position(timestamps[first])
+            last = first + 1
+            while last < len(timestamps) and self._position(timestamps[last]) == position:
+                last += 1
+
+            for snapshot in self.segments[position].get_snapshots(timestamps[first:last]):
+                yield snapshot
+
+            first = last
+
+    """
+    Returns a number that identifies the state of the file at timestamp, as FileHistory.count_changes does.
+    It counts the changes of earlier segments plus one for each segment boundary, so states of
+    different segments never share a number.
+    """
+    def count_changes(self, timestamp):
+        position = self._position(timestamp)
+        earlier = sum(len(segment.changes) for segment in self.segments[:position])
+        return earlier + position + self.segments[position].count_changes(timestamp)
+
+    def get_replay_state(self, timestamp):
+        position = self._position(timestamp)
+        return position, self.segments[position].get_replay_state(timestamp)
+
+    def seed_replay(self, state):
+        position, segment_state = state
+        self.segments[position].seed_replay(segment_state)
+
+    """
+    Adds a change to the segment that covers its start time.
+    """
+    def update_history(self, change):
+        self._segment(change.time_1).update_history(change)
+
+    def _position(self, timestamp):
+        return max(bisect.bisect_right(self._starts, timestamp) - 1, 0)
+
+    def _segment(self, timestamp):
+        return self.segments[self._position(timestamp)]
+
+
+"""
+The history of a project recorded in several FLUORITE logs.
+
+The logs are read together in one streaming pass: their logged items are merged on absolute
+time (a k-way merge), so that each file's changes are replayed in order across sessions. A file
+that is not opened again in a later session keeps its last known content, and changes to it
+continue from there. Each log is read once, and only one logged item per log is held in memory.
+
+All logs must use the same line separator. launch_time is the earliest launch time of any log.
+
+Parameters:
+    logfiles: Paths of the FLUORITE log files, in any order.
+
+    func_location_file: Relative path to a JSON file describing the INITIAL
+        locations of functions in the project (see ProjectHistory).
+
+    entity_location_file: Similar to the above, but for an entity index.
+"""
+
+
+class MultiSessionHistory(ProjectHistory):
+    def __init__(self, logfiles, func_location_file=None, entity_location_file=None):
+        self.logfiles = list(logfiles)
+
+        if len(self.logfiles) == 0:
+            raise ValueError(
+                "At least one log file is required"
+            )
+
+        super().__init__(self.logfiles, func_location_file=func_location_file,
+                         entity_location_file=entity_location_file)
+
+    """
+    Parse every log file. (Only performed on construction).
+    """
+    def parse_logfile(self):
+        self.session_launch_times = list()
+
+        # Changes not yet added to the latest segment of each file
+        pending_changes = dict()
+
+        # At equal times, changes come before snapshots, which include them
+        items = heapq.merge(*[self._session_items(logfile) for logfile in self.logfiles],
+                            key=lambda item: (item[0], item[3] is None))
+
+        for item_time, short_name, snapshot_text, change in items:
+            if change is not None:
+                if short_name not in self.project_files:
+                    raise ValueError(
+                        "Bad format: A DocumentChange of "+short_name+" appeared "
+                        "before any snapshot of it was logged."
+                    )
+                pending_changes[short_name].append(change)
+
+            elif short_name not in self.project_files:
+                self.project_files[short_name] = SessionFileHistory(short_name)
+                self.project_files[short_name].add_segment(
+                    item_time, self._new_file_history(short_name, snapshot_text)
+                )
+                pending_changes[short_name] = list()
+
+            else:
+                self._open_session(short_name, item_time, snapshot_text, pending_changes[short_name])
+                pending_changes[short_name] = list()
+
+        for short_name, changes in pending_changes.items():
+            self.project_files[short_name].segments[-1].extend_history(changes)
+
+    """
+    Starts a new segment of a file that is opened at item_time, unless the snapshot is the content
+    that the history already reaches at that time.
+    """
+    def _open_session(self, short_name, item_time, snapshot_text, pending_changes):
+        filehist = self.project_files[short_name]
+        latest = filehist.segments[-1]
+        latest.extend_history(pending_changes)
+
+        content, functions, entities = latest.get_snapshot(item_time)
+        if content == snapshot_text:
+            return
+
+        filehist.add_segment(item_time, FileHistory(short_name, snapshot_text,
+                                                    initial_functions=functions,
+                                                    initial_entities=entities))
+
+    """
+    Generates the snapshots and changes of one log as (time, short file name, snapshot, change)
+    tuples, in which either the snapshot or the change is None.
+    Items are timed by the latest time seen so far in the log, so that the merge keeps
+    the order of each log even where its time stamps are not sorted.
+    """
+    def _session_items(self, logfile):
+        elements = iterparse_log(logfile)
+        root = next(elements)
+        launch_time, line_separator = read_log_attributes(root.attrib)
+
+        if self.line_separator is None:
+            self.line_separator = line_separator
+        elif line_separator != self.line_separator:
+            raise ValueError(
+                "The line separator of "+str(logfile)+" differs from that of "+str(self.logfiles[0])
+            )
+
+        self.session_launch_times.append(launch_time)
+        if self.launch_time is None or launch_time < self.launch_time:
+            self.launch_time = launch_time
+
+        latest_time = launch_time
+        current_file = None
+        for child in elements:
+
+            if child.tag == "Command" and \
+                    child.attrib["_type"] == "FileOpenCommand":
+                current_file, snapshot_text = parse_file_open(child, current_file, line_separator)
+
+                if snapshot_text is not None:
+                    if 'timestamp' in child.attrib.keys():
+                        latest_time = max(latest_time, launch_time + int(child.attrib['timestamp']))
+                    yield latest_time, trim_filepath(current_file), snapshot_text, None
+
+            elif child.tag == "DocumentChange":
+                change = parse_document_change(child, current_file, launch_time, line_separator)
+
+                if change is not None:
+                    latest_time = max(latest_time, change.time_1)
+                    yield latest_time, trim_filepath(current_file), None, change
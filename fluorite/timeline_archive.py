@@ -0,0 +1,279 @@
+"""
+A single-file alternative to the directory tree written by ProjectHistory.save_timeline.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+# Identifies timeline archives, and the version of their layout
+ARCHIVE_MAGIC = b"FLTA"
+ARCHIVE_VERSION = 2
+
+# The default number of periods between keyframes, at which every file is stored in full
+KEYFRAME_INTERVAL = 64
+
+# Header: magic, version
+_HEADER = struct.Struct("<4sH")
+
+# Full record: kind, length in bytes. Followed by the UTF-8 text
+_FULL = struct.Struct("<BI")
+
+# Delta record: kind, offset of the base record, first changed byte, end of the changed bytes
+# in the base, length in bytes. Followed by the UTF-8 bytes that replace them. The offsets are
+# into the UTF-8 encoding of the base, so a delta can be applied without decoding anything
+_DELTA = struct.Struct("<BQQQI")
+
+# Trailer: offset and length of the JSON index, magic
+_TRAILER = struct.Struct("<QQ4s")
+
+_FULL_KIND = 0
+_DELTA_KIND = 1
+
+"""
+Writes a timeline archive sequentially.
+
+An archive holds a list of periods, each of which is a set of named text files (the content of
+a code_files directory). A file is stored as a record: either its full UTF-8 text, or a delta that
+replaces one range of bytes of the record it had in the previous period. Files that do not
+change between periods share a record. Every keyframe_interval periods, all files are stored in
+full, so rebuilding any file takes at most keyframe_interval - 1 deltas.
+
+The records are followed by a JSON index of the periods, and a fixed-size trailer that locates it.
+
+Parameters:
+    path: The archive file to create.
+    keyframe_interval: The number of periods between keyframes.
+"""
+
+
+class TimelineArchiveWriter:
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL):
+        if int(keyframe_interval) < 1:
+            raise ValueError(
+                "keyframe_interval must be a positive integer, not "+str(keyframe_interval)
+            )
+
+        self.path = path
+        self.keyframe_interval = int(keyframe_interval)
+        self.periods = list()
+
+        # For each file name: the key, UTF-8 text, record offset and record kind of its latest version
+        self._latest = dict()
+
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    """
+    Adds the next period. files is a list of (file name, key, text) triples, as produced by
+    ProjectHistory.snapshot_files: text may be a callable, which is only called if the file has
+    no earlier version with the same (non-None) key.
+    """
+    def add_period(self, name, files):
+        keyframe = len(self.periods) % self.keyframe_interval == 0
+        records = dict()
+
+        for file_name, key, text in files:
+            latest = self._latest.get(file_name)
+
+            if latest is not None and key is not None and key == latest[0]:
+                data = latest[1]
+            else:
+                data = (text() if callable(text) else text).encode("utf-8")
+
+            if latest is not None and data == latest[1] and (latest[3] == _FULL_KIND or not keyframe):
+                offset, kind = latest[2], latest[3]
+            elif latest is None or keyframe:
+                offset, kind = self._write_full(data), _FULL_KIND
+            else:
+                offset, kind = self._write_delta(latest[2], latest[1], data), _DELTA_KIND
+
+            self._latest[file_name] = (key, data, offset, kind)
+            records[file_name] = offset
+
+        self.periods.append({"name": str(name), "files": records})
+
+    """
+    Writes the index and the trailer, and closes the archive.
+    """
+    def close(self):
+        if self._file.closed:
+            return
+
+        index = json.dumps({
+            "version": ARCHIVE_VERSION,
+            "keyframe_interval": self.keyframe_interval,
+            "periods": self.periods
+        }).encode("utf-8")
+
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(_TRAILER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+        self._file.close()
+
+    def _write_full(self, data):
+        offset = self._file.tell()
+        self._file.write(_FULL.pack(_FULL_KIND, len(data)))
+        self._file.write(data)
+        return offset
+
+    """
+    Writes a delta that turns base_data into data (both UTF-8), by replacing the bytes between
+    their common prefix and their common suffix.
+    """
+    def _write_delta(self, base_offset, base_data, data):
+        shorter = min(len(base_data), len(data))
+
+        start = _common_length(lambda length: data.startswith(base_data[:length]), shorter)
+        suffix = _common_length(
+            lambda length: data.endswith(base_data[len(base_data) - length:]), shorter - start)
+
+        replacement = data[start:len(data) - suffix]
+        offset = self._file.tell()
+        self._file.write(_DELTA.pack(_DELTA_KIND, base_offset, start, len(base_data) - suffix, len(replacement)))
+        self._file.write(replacement)
+        return offset
+
+
+"""
+Returns the largest length, up to limit, for which matches(length) is True, where matches is true for
+all lengths up to some point and false after it (such as the length of a common prefix). The length is
+found by doubling and then bisecting, so the strings are compared by slices instead of by character.
+"""
+
+
+def _common_length(matches, limit):
+    # Find an upper bound by doubling, so that a short match only compares short slices
+    low, high = 0, 1
+    while high < limit and matches(high):
+        low, high = high, high * 2
+    high = min(high, limit)
+
+    # low always matches; bisect (low, high]
+    while low < high:
+        middle = (low + high + 1) // 2
+        if matches(middle):
+            low = middle
+        else:
+            high = middle - 1
+
+    return low
+
+
+"""
+Reads a timeline archive written by TimelineArchiveWriter. The archive is memory-mapped,
+and any period can be read or extracted without reading the periods before it.
+
+Parameters:
+    path: The archive file.
+"""
+
+
+class TimelineArchive:
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as infile:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = _HEADER.unpack_from(self._map, 0)
+        if magic != ARCHIVE_MAGIC or len(self._map) < _HEADER.size + _TRAILER.size:
+            raise ValueError(
+                str(path)+" is not a timeline archive"
+            )
+
+        if version != ARCHIVE_VERSION:
+            raise ValueError(
+                "Timeline archive version "+str(version)+" is not supported"
+            )
+
+        index_offset, index_length, magic = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(
+                str(path)+" is an incomplete timeline archive"
+            )
+
+        index = json.loads(self._map[index_offset:index_offset + index_length].decode("utf-8"))
+        self.keyframe_interval = index["keyframe_interval"]
+        self._periods = index["periods"]
+
+        # UTF-8 texts of the records used by the most recently read period
+        self._recent = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._periods)
+
+    """
+    The name of each period: the name of its directory in a save_timeline tree.
+    """
+    @property
+    def period_names(self):
+        return [period["name"] for period in self._periods]
+
+    """
+    Returns the files of a period as a dictionary from file names to text.
+    """
+    def get_period(self, index):
+        files = self._periods[index]["files"]
+        records = dict((offset, self._read_record(offset)) for offset in set(files.values()))
+        self._recent = records
+        return dict((file_name, records[offset].decode("utf-8")) for file_name, offset in files.items())
+
+    """
+    Writes the files of a period to directory_path/<period name>/code_files, as save_timeline does.
+    Returns the path of the period directory.
+    """
+    def extract(self, index, directory_path):
+        period_dir = directory_path + "/" + self._periods[index]["name"]
+        target_dir = period_dir + "/code_files"
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        for file_name, text in self.get_period(index).items():
+            with open(target_dir + "/" + file_name, "w") as ofile:
+                ofile.write(text)
+
+        return period_dir
+
+    def close(self):
+        self._map.close()
+
+    """
+    Rebuilds the UTF-8 text of the record at offset, from the nearest full record (or recently read
+    record) in its chain of deltas.
+    """
+    def _read_record(self, offset):
+        chain = list()
+        while offset not in self._recent:
+            kind = self._map[offset]
+            if kind == _FULL_KIND:
+                _, length = _FULL.unpack_from(self._map, offset)
+                start = offset + _FULL.size
+                data = self._map[start:start + length]
+                break
+
+            chain.append(offset)
+            offset = _DELTA.unpack_from(self._map, offset)[1]
+        else:
+            data = self._recent[offset]
+
+        for offset in reversed(chain):
+            _, _, start, end, length = _DELTA.unpack_from(self._map, offset)
+            data_start = offset + _DELTA.size
+            data = data[:start] + self._map[data_start:data_start + length] + data[end:]
+
+        return data
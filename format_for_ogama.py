@@ -3,7 +3,7 @@ Converts plugin logs so that they can be ingested by Ogama.
 """
 
 import xml.etree.ElementTree as xtree
-from fluorite import date_to_epoch
+from fluorite import timestamps_to_epoch
 import pandas as pd
 import glob
 
@@ -13,7 +13,8 @@ trials_dir = "trials_files"
 
 raw_data_sources = glob.glob(raw_data_dir+"/*/P*bug*")
 
-time_offset = 4 * 3600 * 1000
+# Plugin time stamps are converted to UTC using their time zone, so they need no offset
+time_offset = 0
 
 def to_event_time(unix_time, data):
     index = abs(data['unix_time_ms'] - unix_time).idxmin()
@@ -50,12 +51,13 @@ for source in raw_data_sources:
     }
 
     for response in gazes:
-        df_dict['unix_time_ms'].append(
-            date_to_epoch(response.attrib['timestamp']) + time_offset)
+        df_dict['unix_time_ms'].append(response.attrib['timestamp'])
         df_dict['tracker_time_us'].append(int(response.attrib['event_time'])/1000)
         df_dict['fix_x'].append(response.attrib['x'])
         df_dict['fix_y'].append(response.attrib['y'])
 
+    df_dict['unix_time_ms'] = timestamps_to_epoch(df_dict['unix_time_ms']) + time_offset
+
     data = pd.DataFrame.from_dict(df_dict).astype(
         {'unix_time_ms': 'int64', 'tracker_time_us': 'int64'})
 
@@ -1,4 +1,4 @@
 from .aoi import get_code_envelope, get_aoi_intersection, \
     generate_code_mask, generate_gaze_mask
 
-from .translation import post_to_aoi, post_to_csv, append_aoi, create_combined_archive
+from .translation import post_to_aoi, post_to_csv, read_fixations, append_aoi, create_combined_archive
@@ -1,13 +1,31 @@
 import os
 import csv
-import datetime
 from csv import QUOTE_NONE
 import json
 import glob
 import sqlite3
+import numpy
 import pandas
+from fluorite.partition import timestamps_to_epoch
 from .aoi import get_code_envelope, get_aoi_intersection
 
+# Aggregates the gazes of each fixation: the mean of their line/column values, and the time stamp and file
+# of the first of them (the one with the lowest rowid, which is the first in table order)
+FIXATIONS_QUERY = """
+    SELECT first_gaze.fixation_id, fixations.mean_line, fixations.mean_col,
+           first_gaze.time_stamp, first_gaze.object_name
+    FROM (
+        SELECT fixation_id, AVG(line_num) AS mean_line, AVG(col_num) AS mean_col, MIN(rowid) AS first_rowid
+        FROM gazes
+        WHERE fixation_id IS NOT NULL
+        GROUP BY fixation_id
+    ) AS fixations
+    JOIN gazes AS first_gaze ON first_gaze.rowid = fixations.first_rowid
+"""
+
+# The number of fixations fetched from a database at a time
+FETCH_BATCH_SIZE = 10000
+
 """
 Combines all the given data files and sorts the rows by time.
 Parameters:
@@ -40,7 +58,9 @@ Parameters:
     threshold: The threshold parameter for creating a mask (after smoothing)
     func_dict: The path to a JSON function index describing the project.
     entity_dict: The path to a JSON entity index describing the project.
-    time_offset: The number of milliseconds to add to all timestamps (use this to synchronize with FLUORITE data)
+    time_offset: The number of milliseconds to add to all timestamps. Time stamps are converted to UTC
+        using their time zone, so they are already synchronized with FLUORITE data. This used to be
+        the time zone's offset (such as 4*3600*1000), which would now be applied twice; use 0.
     compute_aois: If True, statistically infer the locations of AOIs.
 """
 
@@ -53,6 +73,17 @@ def post_to_aoi(db_fpath, tsv_fpath, code_dir, outdir_name, smoothing, threshold
     # Get names of generated files
     generated_files = glob.glob(outdir_name+"/*.csv")
 
+    # Load the function and entity indexes once, for all generated files
+    func_file_dict = entity_file_dict = None
+
+    if func_dict is not None:
+        with open(func_dict) as infile:
+            func_file_dict = json.load(infile)
+
+    if entity_dict is not None:
+        with open(entity_dict) as infile:
+            entity_file_dict = json.load(infile)
+
     for generated_file in generated_files:
         code_fname = generated_file[:-4].split("\\")[-1]
         code_fpath = code_dir+"/"+code_fname
@@ -90,21 +121,49 @@ def post_to_aoi(db_fpath, tsv_fpath, code_dir, outdir_name, smoothing, threshold
 
             func_file = entity_file = None
 
-            if func_dict is not None:
-                with open(func_dict) as infile:
-                    func_file_dict = json.load(infile)
-                    func_file = func_file_dict[code_fname_no_ext] if code_fname_no_ext in func_file_dict.keys() else None
+            if func_file_dict is not None:
+                func_file = func_file_dict[code_fname_no_ext] if code_fname_no_ext in func_file_dict.keys() else None
 
-            if entity_dict is not None:
-                with open(entity_dict) as infile:
-                    entity_file_dict = json.load(infile)
-                    entity_file = entity_file_dict[code_fname_no_ext] if code_fname_no_ext in entity_file_dict.keys() else None
+            if entity_file_dict is not None:
+                entity_file = entity_file_dict[code_fname_no_ext] if code_fname_no_ext in entity_file_dict.keys() else None
 
             append_entity(
                 target_file, "fix_line", func_file, entity_file, generated_file[:-4]+"_functions.csv"
             )
 
 
+"""
+Reads the fixations of a gaze2src database (db3) file. The gazes are aggregated by SQLite, and the
+results are fetched batch_size fixations at a time, so raw gazes are never loaded.
+Yields (fixation ID, mean line, mean column, time, file name) for each fixation, where the time
+(in epoch milliseconds, plus offset_ms) and the file name are those of its first gaze.
+A mean is NaN if none of the gazes of the fixation have a line/column.
+"""
+
+
+def read_fixations(db_fpath, offset_ms, batch_size=FETCH_BATCH_SIZE):
+    conn = sqlite3.connect(db_fpath)
+
+    try:
+        cursor = conn.execute(FIXATIONS_QUERY)
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+
+            # Convert the time stamps of the batch at once
+            fix_times = timestamps_to_epoch([row[3] for row in rows]) + offset_ms
+
+            for (fix_id, mean_line, mean_col, _, fname), fix_time in zip(rows, fix_times):
+                yield (fix_id,
+                       float("nan") if mean_line is None else mean_line,
+                       float("nan") if mean_col is None else mean_col,
+                       int(fix_time), fname)
+    finally:
+        conn.close()
+
+
 """
 Convert iTrace's database and TSV files to a CSV.
 
@@ -112,7 +171,9 @@ Parameters:
     db_fpath: The path to a a database (db3) file created by gaze2src
     tsv_fpath: The path to the corresponding TSV file created by gaze2src
     outdir_name: Where to save outputs (AOI location files and data files)
-    offset_ms: The number of milliseconds to add to all timestamps (use this to synchronize with FLUORITE data)
+    offset_ms: The number of milliseconds to add to all timestamps. Time stamps are converted to UTC
+        using their time zone, so they are already synchronized with FLUORITE data. Offsets that made
+        up for the time zone in older versions must be set to 0, or fix_time is shifted by it twice.
 """
 
 
@@ -130,85 +191,43 @@ def post_to_csv(db_fpath, tsv_fpath, outdir_name, offset_ms):
         "which_file"
     ]
 
-    # Read database into pandas dataframe
-    conn = sqlite3.connect(db_fpath)
-
-    # Select rows for which fixation_id is not null
-    df = pandas.read_sql_query(
-        "SELECT * FROM gazes WHERE fixation_id IS NOT NULL",
-        conn
-    )
+    # Aggregate each fixation in the database, and index the results by fixation ID
+    fixations = dict((fixation[0], fixation[1:]) for fixation in read_fixations(db_fpath, offset_ms))
 
-    # Multi-file output
-    open_files = dict()
+    # Multi-file output. Rows are gathered by file, and each file is written once.
+    rows_by_file = dict()
     if not os.path.isdir(outdir_name):
         os.makedirs(outdir_name)
 
-    try:
-        epoch = datetime.datetime.fromtimestamp(0)
-    except OSError:
-        epoch = datetime.datetime.utcfromtimestamp(0)
-
     # Open tsv
     with open(tsv_fpath, "r", newline="") as infile:
         itsv = csv.DictReader(infile, delimiter='\t', quoting=QUOTE_NONE)
 
-        current_fname, current_file, ocsv = None, None, None
-
         for input_row in itsv:
             fix_id = int(input_row["FIXATION_ID"])
 
-            # Find all occurrences of this ID in the dataframe
-            id_data = df.loc[df['fixation_id'] == fix_id]
-
-            # There might not be any (if this is the case, continue)
-            if id_data.shape[0] == 0:
+            # Find the aggregated gazes of this ID. There might not be any (if this is the case, continue)
+            try:
+                mean_line, mean_col, fix_time, fname = fixations[fix_id]
+            except KeyError:
                 continue
 
             # Get fixation location by rounding the mean of line/column values
-            means = id_data.loc[:, ['line_num', 'col_num']].mean()
-            mean_line, mean_col = means['line_num'], means['col_num']
-
             try:
                 nearest_line, nearest_col = int(round(mean_line)), int(round(mean_col))
             except ValueError:
                 nearest_line, nearest_col = None, None
 
-            # Get time stamp from df
-            tstamp = id_data['time_stamp'].iloc[0]
-
-            # Get file name
-            fname = id_data['object_name'].iloc[0]
-
             # Get x, y coordinates
             pixel_x, pixel_y = input_row["X"], input_row["Y"]
 
             # Get pupil dilation
             diameter_left, diameter_right = input_row["LEFT_PUPIL"], input_row["RIGHT_PUPIL"]
 
-            # Decide which file to write to
-            #  (New file)
-            if fname not in open_files.keys():
-                if current_fname is not None:
-                    current_file.close()
-                current_fname = fname
-                current_file = open_files[fname] = open(outdir_name + "/" + fname + ".csv", "w", newline="")
-                ocsv = csv.DictWriter(current_file, fieldnames=output_fieldnames)
-                ocsv.writeheader()
-
-            # (File that was previously opened)
-            elif fname != current_fname:
-                current_file.close()
-                current_fname = fname
-                current_file = open_files[fname] = open(outdir_name + "/" + fname + ".csv", "a", newline="")
-                ocsv = csv.DictWriter(current_file, fieldnames=output_fieldnames)
-
-            # Write to output file
-            ocsv.writerow({
+            rows_by_file.setdefault(fname, list()).append({
                 "fix_col": nearest_col if nearest_col else "NONE",
                 "fix_line": nearest_line if nearest_line else "NONE",
-                "fix_time": int((datetime.datetime.strptime(tstamp[:-6], "%Y-%m-%dT%H:%M:%S.%f") - epoch)
-                                .total_seconds() * 1000 + offset_ms),
+                "fix_time": int(fix_time),
                 "fix_dur": input_row["DURATION"],
                 "pixel_x": pixel_x,
                 "pixel_y": pixel_y,
@@ -217,8 +236,12 @@ def post_to_csv(db_fpath, tsv_fpath, outdir_name, offset_ms):
                 "which_file": fname
             })
 
-        if current_file is not None:
-            current_file.close()
+    # Write each output file
+    for fname, rows in rows_by_file.items():
+        with open(outdir_name + "/" + fname + ".csv", "w", newline="") as ofile:
+            ocsv = csv.DictWriter(ofile, fieldnames=output_fieldnames)
+            ocsv.writeheader()
+            ocsv.writerows(rows)
 
 
 def is_inside(rectangle, x, y):
@@ -226,6 +249,49 @@ def is_inside(rectangle, x, y):
         int(rectangle["B"]) >= y >= int(rectangle["T"])
 
 
+"""
+A lookup table of the AOI that contains each point, for a list of AOI rectangles (as described for append_aoi).
+The plane is cut into cells at the edges of the rectangles, and each cell is labeled with the first AOI
+that contains it, or -1 if there is none. Looking up points is then a single gather.
+"""
+
+
+class AOIRaster:
+    def __init__(self, aois):
+        lefts = numpy.array([int(aoi["L"]) for aoi in aois], dtype=numpy.int64)
+        rights = numpy.array([int(aoi["R"]) for aoi in aois], dtype=numpy.int64) + 1
+        tops = numpy.array([int(aoi["T"]) for aoi in aois], dtype=numpy.int64)
+        bottoms = numpy.array([int(aoi["B"]) for aoi in aois], dtype=numpy.int64) + 1
+
+        # Cell boundaries. Cell [i, j] holds the points with y_edges[i] <= y < y_edges[i + 1]
+        # and x_edges[j] <= x < x_edges[j + 1]
+        self.x_edges = numpy.unique(numpy.concatenate([lefts, rights]))
+        self.y_edges = numpy.unique(numpy.concatenate([tops, bottoms]))
+        self.labels = numpy.full((max(len(self.y_edges) - 1, 0), max(len(self.x_edges) - 1, 0)), -1,
+                                 dtype=numpy.int64)
+
+        # Paint the AOIs in reverse order, so that each cell ends up with the first AOI that contains it
+        x_starts, x_ends = numpy.searchsorted(self.x_edges, lefts), numpy.searchsorted(self.x_edges, rights)
+        y_starts, y_ends = numpy.searchsorted(self.y_edges, tops), numpy.searchsorted(self.y_edges, bottoms)
+        for i in reversed(range(len(aois))):
+            self.labels[y_starts[i]:y_ends[i], x_starts[i]:x_ends[i]] = i
+
+    """
+    Returns the AOI number of each point (x[i], y[i]), or -1 for points that are not inside any AOI.
+    """
+    def lookup(self, x, y):
+        x = numpy.asarray(x, dtype=numpy.int64)
+        y = numpy.asarray(y, dtype=numpy.int64)
+
+        columns = numpy.searchsorted(self.x_edges, x, side="right") - 1
+        rows = numpy.searchsorted(self.y_edges, y, side="right") - 1
+        inside = (columns >= 0) & (columns < self.labels.shape[1]) & (rows >= 0) & (rows < self.labels.shape[0])
+
+        aoi_numbers = numpy.full(len(x), -1, dtype=numpy.int64)
+        aoi_numbers[inside] = self.labels[rows[inside], columns[inside]]
+        return aoi_numbers
+
+
 """
 Takes a CSV with fixation data and appends a column specifying an AOI.
 
@@ -272,50 +338,126 @@ def append_aoi(data_filepath, x_fieldname, y_fieldname, aoi_filepath, output_fpa
                     "Field not found in data file: "+str(field)
                 )
 
-        with open(output_fpath, "w", newline="") as ofile:
-            ocsv = csv.DictWriter(ofile, fieldnames=icsv.fieldnames+["AOI"])
-            ocsv.writeheader()
-            for row in icsv:
+        fieldnames = icsv.fieldnames
+        rows = list(icsv)
+
+    # Find the AOI of every fixation at once
+    if len(aois) > 0:
+        fix_aois = AOIRaster(aois).lookup([int(row[x_fieldname]) for row in rows],
+                                          [int(row[y_fieldname]) for row in rows])
+    else:
+        fix_aois = [-1] * len(rows)
+
+    with open(output_fpath, "w", newline="") as ofile:
+        ocsv = csv.DictWriter(ofile, fieldnames=fieldnames+["AOI"])
+        ocsv.writeheader()
+        for row, fix_aoi in zip(rows, fix_aois):
+            out_row = dict(row)
+            out_row["AOI"] = str(fix_aoi)
+            ocsv.writerow(out_row)
+
+
+"""
+A lookup table from line numbers to the first of a list of named, inclusive line ranges that contains
+them (as in the function and entity indexes). Lines are cut into segments at the ends of the ranges,
+and each segment is labeled with the number of the first range that contains it, or -1 if there is none.
+
+Parameters:
+    ranges: A list of (name, first line, last line) triples.
+"""
+
+
+class LineIndex:
+    def __init__(self, ranges):
+        self.names = [name for name, _, _ in ranges]
+        starts = numpy.array([int(start) for _, start, _ in ranges], dtype=numpy.int64)
+        ends = numpy.array([int(end) for _, _, end in ranges], dtype=numpy.int64) + 1
+
+        # Segment i holds the lines with edges[i] <= line < edges[i + 1]
+        self.edges = numpy.unique(numpy.concatenate([starts, ends]))
+        self.labels = numpy.full(max(len(self.edges) - 1, 0), -1, dtype=numpy.int64)
+
+        # Paint the ranges in reverse order, so that each segment ends up with the first range that contains it
+        segment_starts, segment_ends = numpy.searchsorted(self.edges, starts), numpy.searchsorted(self.edges, ends)
+        for i in reversed(range(len(ranges))):
+            self.labels[segment_starts[i]:segment_ends[i]] = i
+
+    """
+    Returns the name of the range that contains each line, or "NONE" for lines that are not in any range.
+    """
+    def lookup(self, lines):
+        lines = numpy.asarray(lines, dtype=numpy.int64)
+
+        segments = numpy.searchsorted(self.edges, lines, side="right") - 1
+        inside = (segments >= 0) & (segments < len(self.labels))
+
+        range_numbers = numpy.full(len(lines), -1, dtype=numpy.int64)
+        range_numbers[inside] = self.labels[segments[inside]]
+
+        # -1 picks the last name, "NONE"
+        return numpy.array(self.names + ["NONE"], dtype=object)[range_numbers]
+
 
-                # deduce itrace_post
-                fix_x = row[x_fieldname]
-                fix_y = row[y_fieldname]
-                fix_aoi = None
+"""
+Returns the (name, first line, last line) ranges of a function index, in the order that get_function checks them.
+"""
+
+
+def function_ranges(function_dict):
+    if function_dict is None:
+        return []
 
-                for i in range(len(aois)):
-                    if is_inside(aois[i], int(fix_x), int(fix_y)):
-                        fix_aoi = i
-                        break
+    return [(key, loc[0], loc[1]) for key, loc in function_dict.items()]
 
-                out_row = dict(row)
 
-                if fix_aoi is None:
-                    fix_aoi = -1
+"""
+Returns the (name, first line, last line) ranges of an entity index, in the order that get_entity_type checks them.
+"""
+
+
+def entity_ranges(entity_dict):
+    if entity_dict is None:
+        return []
 
-                out_row["AOI"] = str(fix_aoi)
-                ocsv.writerow(out_row)
+    return [(key, loc2[0], loc2[1]) for key, loc in entity_dict.items() for loc2 in loc.values()]
 
 
 """
-Adds function and entity columns to the data.
+Returns the name of the range that contains the line of each row, or "NONE". Line numbers are only
+converted to int if there are ranges to look them up in.
+"""
+
+
+def label_lines(rows, line_fieldname, ranges):
+    if len(ranges) == 0:
+        return ["NONE"] * len(rows)
+
+    return LineIndex(ranges).lookup([int(row[line_fieldname]) for row in rows])
+
+
+"""
+Adds function and entity columns to the data. The function and entity indexes are turned into
+line lookup tables once, and all rows are labeled at once.
 """
 
 
 def append_entity(data_filepath, line_fieldname, function_dict, entity_dict, output_fpath):
     with open(data_filepath, "r") as infile:
         icsv = csv.DictReader(infile)
-
-        with open(output_fpath, "w", newline="") as ofile:
-            ocsv = csv.DictWriter(ofile, fieldnames=icsv.fieldnames + ["function", "entity"])
-            ocsv.writeheader()
-            for row in icsv:
-                out_row = dict(row)
-                line_num = row[line_fieldname]
-                entity_type = get_entity_type(line_num, entity_dict)
-                function_name = get_function(line_num, function_dict)
-                out_row["entity"] = entity_type
-                out_row["function"] = function_name
-                ocsv.writerow(out_row)
+        fieldnames = icsv.fieldnames
+        rows = list(icsv)
+
+    entity_types = label_lines(rows, line_fieldname, entity_ranges(entity_dict))
+    function_names = label_lines(rows, line_fieldname, function_ranges(function_dict))
+
+    with open(output_fpath, "w", newline="") as ofile:
+        ocsv = csv.DictWriter(ofile, fieldnames=fieldnames + ["function", "entity"])
+        ocsv.writeheader()
+        for row, entity_type, function_name in zip(rows, entity_types, function_names):
+            out_row = dict(row)
+            out_row["entity"] = entity_type
+            out_row["function"] = function_name
+            ocsv.writerow(out_row)
 
 
 def get_function(line_num, function_dict):